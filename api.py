@@ -3,6 +3,11 @@ import logging
 import tracemalloc
 import asyncio
 from main import process_update
+import update_queue
+import strava_events
+import circuit_breaker
+import database
+import strava_client
 
 # Enable tracemalloc
 tracemalloc.start()
@@ -19,25 +24,80 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+async def run_and_close(coro):
+    """Run a coroutine, then close the clients bound to this request's event loop"""
+    try:
+        return await coro
+    finally:
+        await strava_client.close()
+        await database.close_async_redis()
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Handle incoming webhook updates from Telegram"""
     try:
+        if not update_queue.check_secret_token(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+            logger.warning("Rejected webhook update with invalid secret token")
+            return jsonify({"status": "error", "message": "invalid secret token"}), 403
+
         update = request.get_json()
         logger.info(f"Received webhook update: {update}")
         
+        if update_queue.is_queue_mode():
+            # Acknowledge as soon as the update is durably queued for the workers
+            if not update_queue.is_valid_update(update):
+                return jsonify({"status": "error", "message": "invalid update"}), 400
+            if not update_queue.enqueue_update(update):
+                return jsonify({"status": "error", "message": "failed to enqueue update"}), 500
+            return jsonify({"status": "ok"})
+        
         # Process the update asynchronously
-        asyncio.run(process_update(update))
+        asyncio.run(run_and_close(process_update(update)))
         
         return jsonify({"status": "ok"})
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/strava/webhook', methods=['GET'])
+def strava_webhook_validation():
+    """Answer Strava's push subscription validation request"""
+    challenge = strava_events.verify_subscription(
+        request.args.get('hub.mode'),
+        request.args.get('hub.verify_token'),
+        request.args.get('hub.challenge')
+    )
+    if challenge is None:
+        return jsonify({"status": "error", "message": "invalid validation request"}), 403
+    return jsonify({"hub.challenge": challenge})
+
+@app.route('/strava/webhook', methods=['POST'])
+def strava_webhook():
+    """Handle incoming push events from Strava"""
+    try:
+        event = request.get_json()
+        logger.info(f"Received Strava event: {event}")
+        if not strava_events.is_valid_event(event):
+            return jsonify({"status": "error", "message": "invalid event"}), 400
+
+        if update_queue.is_queue_mode():
+            # Strava wants a response within 2 seconds, so workers handle the event afterwards
+            if not update_queue.enqueue_strava_event(event):
+                return jsonify({"status": "error", "message": "failed to enqueue event"}), 500
+            return jsonify({"status": "ok"})
+
+        # Serverless functions are frozen once they respond, so finish the event first
+        asyncio.run(run_and_close(strava_events.handle_event(event)))
+
+        return jsonify({"status": "ok"})
+    except Exception as e:
+        logger.error(f"Error processing Strava event: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
-    return jsonify({"status": "ok"})
+    """Health check endpoint, with the state of the upstream circuits and record caches"""
+    return jsonify({"status": "ok", "circuits": circuit_breaker.get_states(), "cache": database.get_cache_stats()})
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=3000) 
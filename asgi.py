@@ -0,0 +1,118 @@
+import os
+import logging
+import contextlib
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, HTMLResponse
+from starlette.routing import Route
+from starlette.background import BackgroundTask
+from main import process_update, get_bot
+from oauth_server import render_callback
+import database
+import update_queue
+import telegram_outbox
+import strava_client
+import circuit_breaker
+import strava_events
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler()  # Only use stdout/stderr
+    ]
+)
+logger = logging.getLogger(__name__)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Initialize the shared Telegram bot on startup and close its HTTP pool on shutdown"""
+    bot = get_bot()
+    await bot.initialize()
+    logger.info("Shared Telegram bot initialized")
+    try:
+        yield
+    finally:
+        await telegram_outbox.close()
+        await strava_client.close()
+        await database.close_async_redis()
+        await bot.shutdown()
+        logger.info("Shared Telegram bot shut down")
+
+async def webhook(request):
+    """Handle incoming webhook updates from Telegram"""
+    try:
+        if not update_queue.check_secret_token(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+            logger.warning("Rejected webhook update with invalid secret token")
+            return JSONResponse({"status": "error", "message": "invalid secret token"}, status_code=403)
+
+        update = await request.json()
+        logger.info(f"Received webhook update: {update}")
+
+        if update_queue.is_queue_mode():
+            # Acknowledge as soon as the update is durably queued for the workers
+            if not update_queue.is_valid_update(update):
+                return JSONResponse({"status": "error", "message": "invalid update"}, status_code=400)
+            if not await update_queue.enqueue_update_async(update):
+                return JSONResponse({"status": "error", "message": "failed to enqueue update"}, status_code=500)
+            return JSONResponse({"status": "ok"})
+
+        # Process the update on the server's event loop with the shared bot
+        await process_update(update, bot=get_bot())
+
+        return JSONResponse({"status": "ok"})
+    except Exception as e:
+        logger.error(f"Error processing webhook: {str(e)}")
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+async def strava_webhook_validation(request):
+    """Answer Strava's push subscription validation request"""
+    challenge = strava_events.verify_subscription(
+        request.query_params.get('hub.mode'),
+        request.query_params.get('hub.verify_token'),
+        request.query_params.get('hub.challenge')
+    )
+    if challenge is None:
+        return JSONResponse({"status": "error", "message": "invalid validation request"}, status_code=403)
+    return JSONResponse({"hub.challenge": challenge})
+
+async def strava_webhook(request):
+    """Handle incoming push events from Strava"""
+    try:
+        event = await request.json()
+        logger.info(f"Received Strava event: {event}")
+        if not strava_events.is_valid_event(event):
+            return JSONResponse({"status": "error", "message": "invalid event"}, status_code=400)
+
+        # Strava expects a response within two seconds, so handle the event after responding
+        return JSONResponse({"status": "ok"}, background=BackgroundTask(strava_events.handle_event, event, bot=get_bot()))
+    except Exception as e:
+        logger.error(f"Error processing Strava event: {str(e)}")
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+async def health_check(request):
+    """Health check endpoint, with the state of the upstream circuits and record caches"""
+    return JSONResponse({"status": "ok", "circuits": circuit_breaker.get_states(), "cache": database.get_cache_stats()})
+
+async def callback(request):
+    """Handle the OAuth callback from Strava"""
+    return HTMLResponse(render_callback(
+        request.query_params.get('code'),
+        request.query_params.get('state'),
+        request.query_params.get('error')
+    ))
+
+app = Starlette(
+    routes=[
+        Route('/webhook', webhook, methods=['POST']),
+        Route('/strava/webhook', strava_webhook_validation, methods=['GET']),
+        Route('/strava/webhook', strava_webhook, methods=['POST']),
+        Route('/health', health_check, methods=['GET']),
+        Route('/', callback, methods=['GET']),
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 3000)))
@@ -0,0 +1,164 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+from collections import Counter
+import telegram
+import database
+import telegram_outbox
+from circuit_breaker import CircuitOpenError
+from main import get_bot, TELEGRAM_RETRY_POLICY
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# broadcast:{id} holds the message, broadcast:{id}:results each recipient's outcome
+BROADCAST_KEY_PREFIX = 'broadcast:'
+# Messages in flight at once; the outbox keeps the actual rate within Telegram's limits
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '30'))
+# Recipients whose progress is looked up in one round trip
+CHECKPOINT_BATCH_SIZE = 100
+
+DELIVERED = 'delivered'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+def _results_key(broadcast_id):
+    return f"{BROADCAST_KEY_PREFIX}{broadcast_id}:results"
+
+def create_broadcast(text, parse_mode=None, broadcast_id=None):
+    """Store a new broadcast and return its ID"""
+    broadcast_id = broadcast_id or time.strftime('%Y%m%d%H%M%S')
+    key = f"{BROADCAST_KEY_PREFIX}{broadcast_id}"
+    if database.get_redis().exists(key):
+        raise ValueError(f"Broadcast {broadcast_id} already exists, resume it instead")
+    database.get_redis().hset(key, mapping={
+        'text': text,
+        'parse_mode': parse_mode or '',
+        'status': 'created',
+        'created_at': int(time.time())
+    })
+    logger.info(f"Created broadcast {broadcast_id}")
+    return broadcast_id
+
+def get_results(broadcast_id):
+    """Count the recipients of a broadcast by outcome"""
+    counts = Counter({DELIVERED: 0, BLOCKED: 0, FAILED: 0})
+    for _, outcome in database.get_redis().hscan_iter(_results_key(broadcast_id)):
+        counts[outcome] += 1
+    return dict(counts)
+
+async def get_results_async(broadcast_id):
+    """Like get_results, without blocking the event loop"""
+    counts = Counter({DELIVERED: 0, BLOCKED: 0, FAILED: 0})
+    async for _, outcome in database.get_async_redis().hscan_iter(_results_key(broadcast_id)):
+        counts[outcome] += 1
+    return dict(counts)
+
+async def _send(bot, chat_id, text, parse_mode):
+    try:
+        await TELEGRAM_RETRY_POLICY.run(telegram_outbox.send_message, bot, chat_id, text, parse_mode=parse_mode)
+        return DELIVERED
+    except telegram.error.Forbidden:
+        # The user blocked the bot or deleted their account
+        return BLOCKED
+    except (telegram.error.TelegramError, CircuitOpenError) as e:
+        logger.error(f"Error broadcasting to {chat_id}: {str(e)}")
+        return FAILED
+
+async def _pending_recipients(broadcast_id):
+    """Yield the recipients not yet delivered to or known to have blocked the bot"""
+    results_key = _results_key(broadcast_id)
+    batch = []
+    async for chat_id in database.iter_users_async():
+        batch.append(chat_id)
+        if len(batch) == CHECKPOINT_BATCH_SIZE:
+            for pending in await _filter_done(results_key, batch):
+                yield pending
+            batch = []
+    if batch:
+        for pending in await _filter_done(results_key, batch):
+            yield pending
+
+async def _filter_done(results_key, chat_ids):
+    outcomes = await database.get_async_redis().hmget(results_key, chat_ids)
+    return [chat_id for chat_id, outcome in zip(chat_ids, outcomes) if outcome not in (DELIVERED, BLOCKED)]
+
+async def run_broadcast(broadcast_id, concurrency=BROADCAST_CONCURRENCY):
+    """Send a broadcast to every user it hasn't reached yet, returning the counts by outcome
+
+    Each recipient's outcome is checkpointed as it is sent, so running a
+    broadcast again resumes it: delivered and blocked recipients are skipped,
+    failed ones are retried.
+    """
+    key = f"{BROADCAST_KEY_PREFIX}{broadcast_id}"
+    client = database.get_async_redis()
+    broadcast = await client.hgetall(key)
+    if not broadcast:
+        await database.close_async_redis()
+        raise ValueError(f"Broadcast {broadcast_id} not found")
+    text = broadcast['text']
+    parse_mode = broadcast['parse_mode'] or None
+    results_key = _results_key(broadcast_id)
+    await client.hset(key, 'status', 'running')
+
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker(bot):
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            outcome = await _send(bot, chat_id, text, parse_mode)
+            try:
+                await client.hset(results_key, chat_id, outcome)
+            except Exception as e:
+                # Without the checkpoint this recipient is just sent to again on resume
+                logger.error(f"Error recording broadcast outcome for {chat_id}: {str(e)}")
+
+    async with get_bot() as bot:
+        workers = [asyncio.create_task(worker(bot)) for _ in range(concurrency)]
+        try:
+            async for chat_id in _pending_recipients(broadcast_id):
+                await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            results = await get_results_async(broadcast_id)
+            await client.hset(key, 'status', 'done')
+        finally:
+            for task in workers:
+                task.cancel()
+            await telegram_outbox.close()
+            await database.close_async_redis()
+
+    logger.info(f"Broadcast {broadcast_id} finished: {results}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send a message to every connected user')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    start = subparsers.add_parser('start', help='Create a broadcast and send it')
+    start.add_argument('text', help='Message to send')
+    start.add_argument('--id', help='Broadcast ID (defaults to the current time)')
+    start.add_argument('--parse-mode', choices=['HTML', 'Markdown'], help='Telegram parse mode of the message')
+    start.add_argument('--concurrency', type=int, default=BROADCAST_CONCURRENCY)
+    resume = subparsers.add_parser('resume', help='Continue an interrupted broadcast and retry failed recipients')
+    resume.add_argument('id')
+    resume.add_argument('--concurrency', type=int, default=BROADCAST_CONCURRENCY)
+    status = subparsers.add_parser('status', help='Show the counts of a broadcast')
+    status.add_argument('id')
+    args = parser.parse_args()
+
+    if args.command == 'start':
+        broadcast_id = create_broadcast(args.text, args.parse_mode, args.id)
+        print(f"Broadcast {broadcast_id}: {asyncio.run(run_broadcast(broadcast_id, args.concurrency))}")
+    elif args.command == 'resume':
+        print(f"Broadcast {args.id}: {asyncio.run(run_broadcast(args.id, args.concurrency))}")
+    elif args.command == 'status':
+        print(f"Broadcast {args.id} ({database.get_redis().hget(f'{BROADCAST_KEY_PREFIX}{args.id}', 'status')}): {get_results(args.id)}")
@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Open once this share of the calls in the window failed, given enough calls
+CIRCUIT_FAILURE_RATE = float(os.getenv('CIRCUIT_FAILURE_RATE', '0.5'))
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', '10'))
+CIRCUIT_WINDOW_SECONDS = float(os.getenv('CIRCUIT_WINDOW_SECONDS', '60'))
+# How long an open circuit rejects calls before letting a probe through
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+class CircuitBreaker:
+    """Stop calling an upstream that keeps failing, and probe it until it recovers
+
+    Closed: calls go through and their outcomes are kept for the last
+    `window_seconds`; once at least `min_calls` were made and `failure_rate` of
+    them failed, the circuit opens. Open: calls are rejected straight away for
+    `open_seconds`. Half-open: a single probe call goes through; success closes
+    the circuit, failure opens it again.
+    """
+
+    def __init__(self, name, failure_rate=CIRCUIT_FAILURE_RATE, min_calls=CIRCUIT_MIN_CALLS,
+                 window_seconds=CIRCUIT_WINDOW_SECONDS, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._calls = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            _, success = self._calls.popleft()
+            if not success:
+                self._failures -= 1
+
+    def _open(self, now):
+        self.state = OPEN
+        self._opened_at = now
+        self._probe_started = None
+        self._calls.clear()
+        self._failures = 0
+
+    def allow_request(self):
+        """Check whether a call may go to the upstream now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                logger.info(f"Circuit {self.name} half-open, probing the upstream")
+            # A probe whose outcome was never recorded doesn't block the next one forever
+            if self._probe_started is not None and now - self._probe_started < self.open_seconds:
+                return False
+            self._probe_started = now
+            return True
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may go to the upstream now"""
+        if not self.allow_request():
+            raise CircuitOpenError(f"Circuit {self.name} is open, not calling the upstream")
+
+    def record(self, success):
+        """Record the outcome of a call"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                if success:
+                    logger.info(f"Circuit {self.name} closed, the upstream recovered")
+                    self.state = CLOSED
+                    self._probe_started = None
+                else:
+                    logger.warning(f"Circuit {self.name} probe failed, opening again")
+                    self._open(now)
+                return
+            if self.state == OPEN:
+                return
+
+            self._calls.append((now, success))
+            if not success:
+                self._failures += 1
+            self._trim(now)
+            if len(self._calls) >= self.min_calls and self._failures / len(self._calls) >= self.failure_rate:
+                logger.warning(f"Circuit {self.name} opened after {self._failures} of {len(self._calls)} calls failed")
+                self._open(now)
+
+    def get_state(self):
+        """Get the circuit's state for health checks"""
+        with self._lock:
+            self._trim(time.monotonic())
+            return {'state': self.state, 'calls': len(self._calls), 'failures': self._failures}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(upstream):
+    """Get the circuit breaker of an upstream, creating it on first use"""
+    with _breakers_lock:
+        breaker = _breakers.get(upstream)
+        if breaker is None:
+            breaker = CircuitBreaker(upstream)
+            _breakers[upstream] = breaker
+        return breaker
+
+def get_states():
+    """Get the state of every upstream's circuit"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.get_state() for breaker in breakers}
@@ -1,8 +1,19 @@
 import os
 import json
 import logging
+import time
+import asyncio
+import argparse
+import threading
+import weakref
 from datetime import datetime, timedelta
 import redis
+import redis.asyncio
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+from redis.asyncio.retry import Retry as AsyncRetry
+from cache import TTLCache, MISS
+from storage import StorageBackend, SQLiteBackend, MemoryBackend
 
 # Set up logging
 logging.basicConfig(
@@ -11,97 +22,770 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize Redis client
+# Where user records, auth sessions and the notified ledger live: redis, sqlite or memory
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'redis').lower()
+
+def uses_redis():
+    """Check whether this deployment runs Redis; the Redis-only features are skipped otherwise"""
+    return STORAGE_BACKEND == 'redis'
+
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
-logger.info(f"Initializing Redis client with URL: {redis_url}")
-# Use decode_responses=True to automatically decode Redis responses
-redis_client = redis.from_url(redis_url, decode_responses=True)
+# Connection pool settings shared by the sync and async clients
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', '5'))
+# Idle connections are pinged before reuse after this many seconds
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+# Retries of commands failing with connection errors or timeouts
+REDIS_RETRIES = int(os.getenv('REDIS_RETRIES', '3'))
+
+_redis_client = None
+_redis_client_lock = threading.Lock()
+# One async client per event loop, since its connections can't move between loops
+_async_redis_clients = weakref.WeakKeyDictionary()
+
+def _pool_options():
+    return {
+        'decode_responses': True,
+        'max_connections': REDIS_MAX_CONNECTIONS,
+        'socket_timeout': REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': REDIS_SOCKET_CONNECT_TIMEOUT,
+        'health_check_interval': REDIS_HEALTH_CHECK_INTERVAL,
+        'retry_on_error': [redis.ConnectionError, redis.TimeoutError]
+    }
+
+def get_redis():
+    """Get the shared Redis client, connecting on first use"""
+    global _redis_client
+    with _redis_client_lock:
+        if _redis_client is None:
+            logger.info(f"Initializing Redis client with URL: {redis_url}")
+            pool = redis.ConnectionPool.from_url(
+                redis_url,
+                retry=Retry(ExponentialBackoff(), REDIS_RETRIES),
+                **_pool_options()
+            )
+            _redis_client = redis.Redis(connection_pool=pool)
+        return _redis_client
+
+def get_async_redis():
+    """Get the async Redis client for the running event loop, connecting on first use"""
+    loop = asyncio.get_running_loop()
+    client = _async_redis_clients.get(loop)
+    if client is None:
+        pool = redis.asyncio.ConnectionPool.from_url(
+            redis_url,
+            retry=AsyncRetry(ExponentialBackoff(), REDIS_RETRIES),
+            **_pool_options()
+        )
+        client = redis.asyncio.Redis(connection_pool=pool)
+        _async_redis_clients[loop] = client
+    return client
+
+async def close_async_redis():
+    """Close the async Redis client of the running event loop"""
+    client = _async_redis_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
 
-# Test Redis connection
-try:
-    redis_client.ping()
-    logger.info("Successfully connected to Redis")
-except Exception as e:
-    logger.error(f"Failed to connect to Redis: {str(e)}")
+# Optional in-process cache of user and auth session records; enable it for
+# every process so that their writes announce the keys they changed (over Redis
+# pub/sub, so with other backends cached records just expire after the TTL)
+RECORD_CACHE_ENABLED = os.getenv('RECORD_CACHE_ENABLED', 'false').lower() == 'true'
+RECORD_CACHE_TTL = float(os.getenv('RECORD_CACHE_TTL', '5'))
+RECORD_CACHE_SIZE = int(os.getenv('RECORD_CACHE_SIZE', '10000'))
+# Pub/sub channel carrying the keys of changed records
+CACHE_INVALIDATION_CHANNEL = 'cache_invalidation'
+
+_user_cache = TTLCache(RECORD_CACHE_SIZE, RECORD_CACHE_TTL)
+_auth_session_cache = TTLCache(RECORD_CACHE_SIZE, RECORD_CACHE_TTL)
+_invalidation_listener = None
+_invalidation_listener_lock = threading.Lock()
 
 # Key prefixes
 USER_KEY_PREFIX = 'user:'
 AUTH_SESSION_KEY_PREFIX = 'auth_session:'
+NOTIFIED_KEY_PREFIX = 'notified:'
+ATHLETE_KEY_PREFIX = 'athlete:'
+# Sorted set of chat IDs scored by token expiry timestamp
+USER_EXPIRY_KEY = 'user_expiry'
+# Set of the chat IDs of all connected users
+USERS_KEY = 'users'
+# Chat IDs fetched per SSCAN/SCAN call
+USER_SCAN_BATCH_SIZE = int(os.getenv('USER_SCAN_BATCH_SIZE', '1000'))
+
+# Notified activity IDs are kept per user this long, and at most this many
+NOTIFIED_RETENTION_DAYS = int(os.getenv('NOTIFIED_RETENTION_DAYS', '30'))
+NOTIFIED_MAX_ENTRIES = int(os.getenv('NOTIFIED_MAX_ENTRIES', '500'))
+
+def _cache_for(key):
+    return _auth_session_cache if key.startswith(AUTH_SESSION_KEY_PREFIX) else _user_cache
+
+def _on_invalidation(message):
+    key = message['data']
+    _cache_for(key).invalidate(key)
+
+def _on_invalidation_error(error, pubsub, thread):
+    # Invalidations may have been missed while disconnected
+    logger.error(f"Error listening for cache invalidations: {str(error)}")
+    _user_cache.clear()
+    _auth_session_cache.clear()
+    time.sleep(1)
+
+def _start_invalidation_listener():
+    """Listen for records changed by other processes, once per process"""
+    global _invalidation_listener
+    with _invalidation_listener_lock:
+        if _invalidation_listener is not None:
+            return
+        if not uses_redis():
+            _invalidation_listener = False
+            return
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{CACHE_INVALIDATION_CHANNEL: _on_invalidation})
+            _invalidation_listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=_on_invalidation_error)
+        except Exception as e:
+            # Cached records then only go stale for up to RECORD_CACHE_TTL
+            logger.error(f"Error subscribing to cache invalidations: {str(e)}")
+            _invalidation_listener = False
 
-def add_user(chat_id, access_token, refresh_token, expires_at):
-    """Add a user to Redis"""
+def _get_cached(key):
+    """Get a cached record (or cached absence) by its key, or MISS"""
+    if not RECORD_CACHE_ENABLED:
+        return MISS
+    _start_invalidation_listener()
+    record = _cache_for(key).get(key)
+    # Copies, so callers can't change the cached record
+    return dict(record) if record and record is not MISS else record
+
+def _set_cached(key, record):
+    if RECORD_CACHE_ENABLED:
+        _cache_for(key).set(key, dict(record) if record else record)
+
+def _invalidate(key):
+    """Drop a changed record from this process's cache and tell the other processes"""
+    if not RECORD_CACHE_ENABLED:
+        return
+    _cache_for(key).invalidate(key)
+    if not uses_redis():
+        return
     try:
-        user_data = {
-            'access_token': access_token,
-            'refresh_token': refresh_token,
-            'expires_at': expires_at.isoformat()
-        }
+        get_redis().publish(CACHE_INVALIDATION_CHANNEL, key)
+    except Exception as e:
+        logger.error(f"Error publishing cache invalidation for {key}: {str(e)}")
+
+async def _invalidate_async(key):
+    """Like _invalidate, without blocking the event loop"""
+    if not RECORD_CACHE_ENABLED:
+        return
+    _cache_for(key).invalidate(key)
+    if not uses_redis():
+        return
+    try:
+        await get_async_redis().publish(CACHE_INVALIDATION_CHANNEL, key)
+    except Exception as e:
+        logger.error(f"Error publishing cache invalidation for {key}: {str(e)}")
+
+def get_cache_stats():
+    """Get the hit ratios of the record caches, or None if caching is disabled"""
+    if not RECORD_CACHE_ENABLED:
+        return None
+    return {'user': _user_cache.get_stats(), 'auth_session': _auth_session_cache.get_stats()}
+
+# Move a user's activity cursor forward, leaving it alone if the user was
+# removed meanwhile or the cursor is already past the given activity
+ADVANCE_CURSOR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local current = tonumber(redis.call('HGET', KEYS[1], 'last_activity_ts') or '-1')
+if tonumber(ARGV[1]) < current then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'last_activity_ts', ARGV[1], 'last_activity_id', ARGV[2])
+return 1
+"""
+
+# Delete the lock only if we still hold it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def _queue_add_user(pipe, chat_id, access_token, refresh_token, expires_at, athlete_id):
+    """Queue the writes storing a user and its indexes on a sync or async pipeline"""
+    user_data = {
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_at': expires_at.isoformat()
+    }
+    if athlete_id:
+        user_data['athlete_id'] = str(athlete_id)
+    pipe.hset(f"{USER_KEY_PREFIX}{chat_id}", mapping=user_data)
+    pipe.sadd(USERS_KEY, str(chat_id))
+    pipe.zadd(USER_EXPIRY_KEY, {str(chat_id): expires_at.timestamp()})
+    if athlete_id:
+        pipe.set(f"{ATHLETE_KEY_PREFIX}{athlete_id}", chat_id)
+
+def _queue_remove_user(pipe, chat_id, athlete_id):
+    """Queue the deletes of a user and its index entries on a sync or async pipeline"""
+    pipe.delete(f"{USER_KEY_PREFIX}{chat_id}")
+    pipe.srem(USERS_KEY, str(chat_id))
+    pipe.zrem(USER_EXPIRY_KEY, str(chat_id))
+    if athlete_id:
+        pipe.delete(f"{ATHLETE_KEY_PREFIX}{athlete_id}")
+
+def _queue_set_user_athlete(pipe, chat_id, athlete_id):
+    pipe.hset(f"{USER_KEY_PREFIX}{chat_id}", 'athlete_id', str(athlete_id))
+    pipe.set(f"{ATHLETE_KEY_PREFIX}{athlete_id}", chat_id)
+
+def _queue_claim_activity(pipe, chat_id, activity_id, retention, max_entries):
+    """Queue the ledger writes claiming an activity; the first result tells whether it was added"""
+    key = f"{NOTIFIED_KEY_PREFIX}{chat_id}"
+    now = time.time()
+    pipe.zadd(key, {str(activity_id): now}, nx=True)
+    # Keep the ledger small: drop old entries and cap its size
+    pipe.zremrangebyscore(key, '-inf', now - retention)
+    pipe.zremrangebyrank(key, 0, -max_entries - 1)
+    pipe.expire(key, retention)
+
+def _parse_user(chat_id, user_data):
+    """Build a user record from its hash, or None if the user doesn't exist"""
+    if not user_data:
+        return None
+    return {
+        'chat_id': chat_id,
+        'access_token': user_data['access_token'],
+        'refresh_token': user_data['refresh_token'],
+        'expires_at': datetime.fromisoformat(user_data['expires_at']),
+        'last_activity_ts': int(user_data['last_activity_ts']) if 'last_activity_ts' in user_data else None,
+        'last_activity_id': user_data.get('last_activity_id'),
+        'athlete_id': user_data.get('athlete_id')
+    }
+
+def _parse_users(chat_ids, results):
+    """Map chat IDs to the user records parsed from their hashes"""
+    users = {}
+    for chat_id, user_data in zip(chat_ids, results):
+        try:
+            users[chat_id] = _parse_user(chat_id, user_data)
+        except Exception as e:
+            logger.error(f"Error parsing user {chat_id}: {str(e)}")
+            users[chat_id] = None
+    return users
+
+def _parse_auth_session(session_data):
+    if not session_data:
+        return None
+    return {
+        'state': session_data['state'],
+        'timestamp': datetime.fromisoformat(session_data['timestamp'])
+    }
+
+class RedisBackend(StorageBackend):
+    """Storage in Redis, shared by every process and host using the instance
+
+    Users are hashes indexed by the users set, the expiry ZSET and athlete
+    keys; auth sessions expire through Redis TTLs.
+    """
+
+    def add_user(self, chat_id, access_token, refresh_token, expires_at, athlete_id=None):
+        pipe = get_redis().pipeline()
+        _queue_add_user(pipe, chat_id, access_token, refresh_token, expires_at, athlete_id)
+        pipe.execute()
+
+    async def add_user_async(self, chat_id, access_token, refresh_token, expires_at, athlete_id=None):
+        pipe = get_async_redis().pipeline()
+        _queue_add_user(pipe, chat_id, access_token, refresh_token, expires_at, athlete_id)
+        await pipe.execute()
+
+    def get_user(self, chat_id):
+        return _parse_user(chat_id, get_redis().hgetall(f"{USER_KEY_PREFIX}{chat_id}"))
+
+    async def get_user_async(self, chat_id):
+        return _parse_user(chat_id, await get_async_redis().hgetall(f"{USER_KEY_PREFIX}{chat_id}"))
+
+    def get_users(self, chat_ids):
+        pipe = get_redis().pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipe.hgetall(f"{USER_KEY_PREFIX}{chat_id}")
+        return _parse_users(chat_ids, pipe.execute())
+
+    async def get_users_async(self, chat_ids):
+        pipe = get_async_redis().pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipe.hgetall(f"{USER_KEY_PREFIX}{chat_id}")
+        return _parse_users(chat_ids, await pipe.execute())
+
+    def remove_user(self, chat_id):
+        athlete_id = get_redis().hget(f"{USER_KEY_PREFIX}{chat_id}", 'athlete_id')
+        pipe = get_redis().pipeline()
+        _queue_remove_user(pipe, chat_id, athlete_id)
+        pipe.execute()
+
+    async def remove_user_async(self, chat_id):
+        client = get_async_redis()
+        athlete_id = await client.hget(f"{USER_KEY_PREFIX}{chat_id}", 'athlete_id')
+        pipe = client.pipeline()
+        _queue_remove_user(pipe, chat_id, athlete_id)
+        await pipe.execute()
+
+    def iter_users(self, batch_size):
+        # SSCAN never blocks Redis; a chat ID may rarely be yielded twice if the set is resized meanwhile
+        yield from get_redis().sscan_iter(USERS_KEY, count=batch_size)
+
+    async def iter_users_async(self, batch_size):
+        async for chat_id in get_async_redis().sscan_iter(USERS_KEY, count=batch_size):
+            yield chat_id
+
+    def get_users_expiring_before(self, before, limit=None):
+        if limit is None:
+            return get_redis().zrangebyscore(USER_EXPIRY_KEY, '-inf', before.timestamp())
+        return get_redis().zrangebyscore(USER_EXPIRY_KEY, '-inf', before.timestamp(), start=0, num=limit)
+
+    async def get_users_expiring_before_async(self, before, limit=None):
+        if limit is None:
+            return await get_async_redis().zrangebyscore(USER_EXPIRY_KEY, '-inf', before.timestamp())
+        return await get_async_redis().zrangebyscore(USER_EXPIRY_KEY, '-inf', before.timestamp(), start=0, num=limit)
+
+    def set_user_athlete(self, chat_id, athlete_id):
+        pipe = get_redis().pipeline()
+        _queue_set_user_athlete(pipe, chat_id, athlete_id)
+        pipe.execute()
+
+    async def set_user_athlete_async(self, chat_id, athlete_id):
+        pipe = get_async_redis().pipeline()
+        _queue_set_user_athlete(pipe, chat_id, athlete_id)
+        await pipe.execute()
+
+    def get_chat_id_for_athlete(self, athlete_id):
+        return get_redis().get(f"{ATHLETE_KEY_PREFIX}{athlete_id}")
+
+    async def get_chat_id_for_athlete_async(self, athlete_id):
+        return await get_async_redis().get(f"{ATHLETE_KEY_PREFIX}{athlete_id}")
+
+    def advance_activity_cursor(self, chat_id, activity_ts, activity_id):
+        key = f"{USER_KEY_PREFIX}{chat_id}"
+        return bool(get_redis().eval(ADVANCE_CURSOR_SCRIPT, 1, key, int(activity_ts), str(activity_id)))
+
+    async def advance_activity_cursor_async(self, chat_id, activity_ts, activity_id):
         key = f"{USER_KEY_PREFIX}{chat_id}"
-        logger.info(f"Adding user data to Redis with key: {key}")
-        redis_client.hmset(key, user_data)
-        logger.info(f"Successfully added user {chat_id} to Redis")
+        return bool(await get_async_redis().eval(ADVANCE_CURSOR_SCRIPT, 1, key, int(activity_ts), str(activity_id)))
+
+    def claim_activity_notification(self, chat_id, activity_id, retention, max_entries):
+        pipe = get_redis().pipeline()
+        _queue_claim_activity(pipe, chat_id, activity_id, retention, max_entries)
+        return bool(pipe.execute()[0])
+
+    async def claim_activity_notification_async(self, chat_id, activity_id, retention, max_entries):
+        pipe = get_async_redis().pipeline()
+        _queue_claim_activity(pipe, chat_id, activity_id, retention, max_entries)
+        return bool((await pipe.execute())[0])
+
+    def release_activity_notification(self, chat_id, activity_id):
+        get_redis().zrem(f"{NOTIFIED_KEY_PREFIX}{chat_id}", str(activity_id))
+
+    async def release_activity_notification_async(self, chat_id, activity_id):
+        await get_async_redis().zrem(f"{NOTIFIED_KEY_PREFIX}{chat_id}", str(activity_id))
+
+    def add_auth_session(self, chat_id, state, timestamp, ttl):
+        key = f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"
+        pipe = get_redis().pipeline()
+        pipe.hset(key, mapping={'state': state, 'timestamp': timestamp.isoformat()})
+        pipe.expire(key, ttl)
+        pipe.execute()
+
+    async def add_auth_session_async(self, chat_id, state, timestamp, ttl):
+        key = f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"
+        pipe = get_async_redis().pipeline()
+        pipe.hset(key, mapping={'state': state, 'timestamp': timestamp.isoformat()})
+        pipe.expire(key, ttl)
+        await pipe.execute()
+
+    def get_auth_session(self, chat_id):
+        return _parse_auth_session(get_redis().hgetall(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"))
+
+    async def get_auth_session_async(self, chat_id):
+        return _parse_auth_session(await get_async_redis().hgetall(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"))
+
+    def remove_auth_session(self, chat_id):
+        get_redis().delete(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}")
+
+    async def remove_auth_session_async(self, chat_id):
+        await get_async_redis().delete(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}")
+
+    def acquire_lock(self, name, token, ttl_ms):
+        return bool(get_redis().set(name, token, nx=True, px=ttl_ms))
+
+    async def acquire_lock_async(self, name, token, ttl_ms):
+        return bool(await get_async_redis().set(name, token, nx=True, px=ttl_ms))
+
+    def is_locked(self, name):
+        return bool(get_redis().exists(name))
+
+    async def is_locked_async(self, name):
+        return bool(await get_async_redis().exists(name))
+
+    def release_lock(self, name, token):
+        get_redis().eval(RELEASE_LOCK_SCRIPT, 1, name, token)
+
+    async def release_lock_async(self, name, token):
+        await get_async_redis().eval(RELEASE_LOCK_SCRIPT, 1, name, token)
+
+_BACKENDS = {
+    'redis': RedisBackend,
+    'sqlite': SQLiteBackend,
+    'memory': MemoryBackend
+}
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """Get the configured storage backend, creating it on first use"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if STORAGE_BACKEND not in _BACKENDS:
+                raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND}, expected one of {', '.join(_BACKENDS)}")
+            _storage = _BACKENDS[STORAGE_BACKEND]()
+        return _storage
+
+def add_user(chat_id, access_token, refresh_token, expires_at, athlete_id=None):
+    """Store a user's Strava tokens"""
+    try:
+        logger.info(f"Adding user {chat_id} to {STORAGE_BACKEND} storage")
+        get_storage().add_user(chat_id, access_token, refresh_token, expires_at, athlete_id)
+        _invalidate(f"{USER_KEY_PREFIX}{chat_id}")
+        logger.info(f"Successfully added user {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error adding user {chat_id}: {str(e)}")
+        return False
+
+async def add_user_async(chat_id, access_token, refresh_token, expires_at, athlete_id=None):
+    """Store a user's Strava tokens without blocking the event loop"""
+    try:
+        logger.info(f"Adding user {chat_id} to {STORAGE_BACKEND} storage")
+        await get_storage().add_user_async(chat_id, access_token, refresh_token, expires_at, athlete_id)
+        await _invalidate_async(f"{USER_KEY_PREFIX}{chat_id}")
+        logger.info(f"Successfully added user {chat_id}")
         return True
     except Exception as e:
         logger.error(f"Error adding user {chat_id}: {str(e)}")
         return False
 
-def get_user(chat_id):
-    """Get a user from Redis"""
+def get_user(chat_id, use_cache=True):
+    """Get a user record
+
+    Pass `use_cache=False` to read the stored record even if a copy is cached,
+    e.g. when another process may have just changed it.
+    """
     try:
         key = f"{USER_KEY_PREFIX}{chat_id}"
-        logger.info(f"Getting user data from Redis with key: {key}")
-        user_data = redis_client.hgetall(key)
-        if user_data:
+        if use_cache:
+            user = _get_cached(key)
+            if user is not MISS:
+                return user
+        logger.info(f"Getting user data for {chat_id}")
+        user = get_storage().get_user(chat_id)
+        _set_cached(key, user)
+        if user:
             logger.info(f"Found user data for {chat_id}")
-            return {
-                'chat_id': chat_id,
-                'access_token': user_data['access_token'],
-                'refresh_token': user_data['refresh_token'],
-                'expires_at': datetime.fromisoformat(user_data['expires_at'])
-            }
-        logger.info(f"No user data found for {chat_id}")
+        else:
+            logger.info(f"No user data found for {chat_id}")
+        return user
+    except Exception as e:
+        logger.error(f"Error getting user {chat_id}: {str(e)}")
         return None
+
+async def get_user_async(chat_id, use_cache=True):
+    """Get a user record without blocking the event loop
+
+    Pass `use_cache=False` to read the stored record even if a copy is cached,
+    e.g. when another process may have just changed it.
+    """
+    try:
+        key = f"{USER_KEY_PREFIX}{chat_id}"
+        if use_cache:
+            user = _get_cached(key)
+            if user is not MISS:
+                return user
+        logger.info(f"Getting user data for {chat_id}")
+        user = await get_storage().get_user_async(chat_id)
+        _set_cached(key, user)
+        if user:
+            logger.info(f"Found user data for {chat_id}")
+        else:
+            logger.info(f"No user data found for {chat_id}")
+        return user
     except Exception as e:
         logger.error(f"Error getting user {chat_id}: {str(e)}")
         return None
 
+def get_users(chat_ids):
+    """Get many users in one round trip
+
+    Returns a dict mapping each chat ID to its user record, or to None if the
+    user doesn't exist. Returns an empty dict on failure.
+    """
+    try:
+        users = get_storage().get_users(chat_ids)
+        logger.info(f"Loaded {sum(1 for user in users.values() if user)} of {len(chat_ids)} users")
+        return users
+    except Exception as e:
+        logger.error(f"Error getting {len(chat_ids)} users: {str(e)}")
+        return {}
+
+async def get_users_async(chat_ids):
+    """Like get_users, without blocking the event loop"""
+    try:
+        users = await get_storage().get_users_async(chat_ids)
+        logger.info(f"Loaded {sum(1 for user in users.values() if user)} of {len(chat_ids)} users")
+        return users
+    except Exception as e:
+        logger.error(f"Error getting {len(chat_ids)} users: {str(e)}")
+        return {}
+
 def remove_user(chat_id):
-    """Remove a user from Redis"""
+    """Remove a user"""
     try:
-        key = f"{USER_KEY_PREFIX}{chat_id}"
-        logger.info(f"Removing user data from Redis with key: {key}")
-        redis_client.delete(key)
-        logger.info(f"Successfully removed user {chat_id} from Redis")
+        logger.info(f"Removing user {chat_id}")
+        get_storage().remove_user(chat_id)
+        _invalidate(f"{USER_KEY_PREFIX}{chat_id}")
+        logger.info(f"Successfully removed user {chat_id}")
         return True
     except Exception as e:
         logger.error(f"Error removing user {chat_id}: {str(e)}")
         return False
 
-def get_all_users():
-    """Get all user chat IDs from Redis"""
+async def remove_user_async(chat_id):
+    """Remove a user without blocking the event loop"""
     try:
-        pattern = f"{USER_KEY_PREFIX}*"
-        logger.info(f"Getting all users from Redis with pattern: {pattern}")
-        keys = redis_client.keys(pattern)
-        users = [key.decode('utf-8').replace(USER_KEY_PREFIX, '') for key in keys]
-        logger.info(f"Found {len(users)} users in Redis")
-        return users
+        logger.info(f"Removing user {chat_id}")
+        await get_storage().remove_user_async(chat_id)
+        await _invalidate_async(f"{USER_KEY_PREFIX}{chat_id}")
+        logger.info(f"Successfully removed user {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error removing user {chat_id}: {str(e)}")
+        return False
+
+def get_users_expiring_before(before, limit=None):
+    """Get chat IDs whose token expires before the given datetime, soonest first"""
+    try:
+        chat_ids = get_storage().get_users_expiring_before(before, limit)
+        logger.info(f"Found {len(chat_ids)} users with tokens expiring before {before}")
+        return chat_ids
+    except Exception as e:
+        logger.error(f"Error getting users with tokens expiring before {before}: {str(e)}")
+        return []
+
+async def get_users_expiring_before_async(before, limit=None):
+    """Like get_users_expiring_before, without blocking the event loop"""
+    try:
+        chat_ids = await get_storage().get_users_expiring_before_async(before, limit)
+        logger.info(f"Found {len(chat_ids)} users with tokens expiring before {before}")
+        return chat_ids
     except Exception as e:
-        logger.error(f"Error getting all users: {str(e)}")
+        logger.error(f"Error getting users with tokens expiring before {before}: {str(e)}")
         return []
 
+def set_user_athlete(chat_id, athlete_id):
+    """Record the Strava athlete a user is connected as"""
+    try:
+        get_storage().set_user_athlete(chat_id, athlete_id)
+        _invalidate(f"{USER_KEY_PREFIX}{chat_id}")
+        logger.info(f"Recorded athlete {athlete_id} for user {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error recording athlete {athlete_id} for {chat_id}: {str(e)}")
+        return False
+
+async def set_user_athlete_async(chat_id, athlete_id):
+    """Record the Strava athlete a user is connected as without blocking the event loop"""
+    try:
+        await get_storage().set_user_athlete_async(chat_id, athlete_id)
+        await _invalidate_async(f"{USER_KEY_PREFIX}{chat_id}")
+        logger.info(f"Recorded athlete {athlete_id} for user {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error recording athlete {athlete_id} for {chat_id}: {str(e)}")
+        return False
+
+def get_chat_id_for_athlete(athlete_id):
+    """Get the chat ID connected to a Strava athlete"""
+    try:
+        chat_id = get_storage().get_chat_id_for_athlete(athlete_id)
+        if not chat_id:
+            logger.info(f"No user found for athlete {athlete_id}")
+        return chat_id
+    except Exception as e:
+        logger.error(f"Error getting user for athlete {athlete_id}: {str(e)}")
+        return None
+
+async def get_chat_id_for_athlete_async(athlete_id):
+    """Get the chat ID connected to a Strava athlete without blocking the event loop"""
+    try:
+        chat_id = await get_storage().get_chat_id_for_athlete_async(athlete_id)
+        if not chat_id:
+            logger.info(f"No user found for athlete {athlete_id}")
+        return chat_id
+    except Exception as e:
+        logger.error(f"Error getting user for athlete {athlete_id}: {str(e)}")
+        return None
+
+def advance_activity_cursor(chat_id, activity_ts, activity_id):
+    """Record the latest activity a user was notified about"""
+    try:
+        advanced = get_storage().advance_activity_cursor(chat_id, activity_ts, activity_id)
+        if advanced:
+            _invalidate(f"{USER_KEY_PREFIX}{chat_id}")
+            logger.info(f"Advanced activity cursor for {chat_id} to {activity_ts} ({activity_id})")
+        return advanced
+    except Exception as e:
+        logger.error(f"Error advancing activity cursor for {chat_id}: {str(e)}")
+        return False
+
+async def advance_activity_cursor_async(chat_id, activity_ts, activity_id):
+    """Record the latest activity a user was notified about without blocking the event loop"""
+    try:
+        advanced = await get_storage().advance_activity_cursor_async(chat_id, activity_ts, activity_id)
+        if advanced:
+            await _invalidate_async(f"{USER_KEY_PREFIX}{chat_id}")
+            logger.info(f"Advanced activity cursor for {chat_id} to {activity_ts} ({activity_id})")
+        return advanced
+    except Exception as e:
+        logger.error(f"Error advancing activity cursor for {chat_id}: {str(e)}")
+        return False
+
+def claim_activity_notification(chat_id, activity_id):
+    """Claim the right to notify a user about an activity
+    
+    Returns True if this caller should send the notification, False if it was
+    already claimed and None if the ledger couldn't be checked.
+    """
+    try:
+        retention = NOTIFIED_RETENTION_DAYS * 24 * 60 * 60
+        added = get_storage().claim_activity_notification(chat_id, activity_id, retention, NOTIFIED_MAX_ENTRIES)
+        if not added:
+            logger.info(f"Activity {activity_id} was already notified to {chat_id}")
+        return added
+    except Exception as e:
+        logger.error(f"Error claiming notification of activity {activity_id} for {chat_id}: {str(e)}")
+        return None
+
+async def claim_activity_notification_async(chat_id, activity_id):
+    """Like claim_activity_notification, without blocking the event loop"""
+    try:
+        retention = NOTIFIED_RETENTION_DAYS * 24 * 60 * 60
+        added = await get_storage().claim_activity_notification_async(chat_id, activity_id, retention, NOTIFIED_MAX_ENTRIES)
+        if not added:
+            logger.info(f"Activity {activity_id} was already notified to {chat_id}")
+        return added
+    except Exception as e:
+        logger.error(f"Error claiming notification of activity {activity_id} for {chat_id}: {str(e)}")
+        return None
+
+def release_activity_notification(chat_id, activity_id):
+    """Release a claim whose notification couldn't be sent so it can be retried"""
+    try:
+        get_storage().release_activity_notification(chat_id, activity_id)
+        logger.info(f"Released notification claim of activity {activity_id} for {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error releasing notification of activity {activity_id} for {chat_id}: {str(e)}")
+        return False
+
+async def release_activity_notification_async(chat_id, activity_id):
+    """Release a claim without blocking the event loop"""
+    try:
+        await get_storage().release_activity_notification_async(chat_id, activity_id)
+        logger.info(f"Released notification claim of activity {activity_id} for {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error releasing notification of activity {activity_id} for {chat_id}: {str(e)}")
+        return False
+
+def iter_users(batch_size=USER_SCAN_BATCH_SIZE):
+    """Yield the chat IDs of all users without loading them all at once"""
+    try:
+        yield from get_storage().iter_users(batch_size)
+    except Exception as e:
+        logger.error(f"Error iterating users: {str(e)}")
+
+async def iter_users_async(batch_size=USER_SCAN_BATCH_SIZE):
+    """Like iter_users, without blocking the event loop"""
+    try:
+        async for chat_id in get_storage().iter_users_async(batch_size):
+            yield chat_id
+    except Exception as e:
+        logger.error(f"Error iterating users: {str(e)}")
+
+def get_all_users():
+    """Get all user chat IDs (prefer iter_users for large user bases)"""
+    users = list(iter_users())
+    logger.info(f"Found {len(users)} users")
+    return users
+
+def backfill_user_indexes(batch_size=USER_SCAN_BATCH_SIZE):
+    """Add users stored before the users set and expiry/athlete indexes existed
+
+    Walks the user keys with SCAN, so it is safe to run against a live
+    instance. Only applies to the Redis backend. Returns the number of users
+    indexed.
+    """
+    count = 0
+    keys = []
+
+    def index(keys):
+        read = get_redis().pipeline(transaction=False)
+        for key in keys:
+            read.hmget(key, 'expires_at', 'athlete_id')
+        write = get_redis().pipeline(transaction=False)
+        for key, (expires_at, athlete_id) in zip(keys, read.execute()):
+            chat_id = key[len(USER_KEY_PREFIX):]
+            write.sadd(USERS_KEY, chat_id)
+            if expires_at:
+                write.zadd(USER_EXPIRY_KEY, {chat_id: datetime.fromisoformat(expires_at).timestamp()})
+            if athlete_id:
+                write.set(f"{ATHLETE_KEY_PREFIX}{athlete_id}", chat_id)
+        write.execute()
+        return len(keys)
+
+    for key in get_redis().scan_iter(match=f"{USER_KEY_PREFIX}*", count=batch_size):
+        keys.append(key)
+        if len(keys) == batch_size:
+            count += index(keys)
+            keys = []
+    if keys:
+        count += index(keys)
+    logger.info(f"Indexed {count} users")
+    return count
+
+# Auth sessions expire after 5 minutes
+AUTH_SESSION_TTL = 300
+
 def add_auth_session(chat_id, state, timestamp):
-    """Add an auth session to Redis"""
+    """Store an auth session"""
     try:
-        key = f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"
-        logger.info(f"Adding auth session to Redis with key: {key}")
-        session_data = {
-            'state': state,
-            'timestamp': timestamp.isoformat()
-        }
-        redis_client.hmset(key, session_data)
-        # Set expiration for 5 minutes
-        redis_client.expire(key, 300)
+        logger.info(f"Adding auth session for {chat_id}")
+        get_storage().add_auth_session(chat_id, state, timestamp, AUTH_SESSION_TTL)
+        _invalidate(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}")
+        logger.info(f"Successfully added auth session for {chat_id} with state {state}")
+        return True
+    except Exception as e:
+        logger.error(f"Error adding auth session for {chat_id}: {str(e)}")
+        return False
+
+async def add_auth_session_async(chat_id, state, timestamp):
+    """Store an auth session without blocking the event loop"""
+    try:
+        logger.info(f"Adding auth session for {chat_id}")
+        await get_storage().add_auth_session_async(chat_id, state, timestamp, AUTH_SESSION_TTL)
+        await _invalidate_async(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}")
         logger.info(f"Successfully added auth session for {chat_id} with state {state}")
         return True
     except Exception as e:
@@ -109,29 +793,61 @@ def add_auth_session(chat_id, state, timestamp):
         return False
 
 def get_auth_session(chat_id):
-    """Get an auth session from Redis"""
+    """Get an auth session"""
     try:
         key = f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"
-        logger.info(f"Getting auth session from Redis with key: {key}")
-        session_data = redis_client.hgetall(key)
-        if session_data:
+        session = _get_cached(key)
+        if session is not MISS:
+            return session
+        logger.info(f"Getting auth session for {chat_id}")
+        session = get_storage().get_auth_session(chat_id)
+        _set_cached(key, session)
+        if session:
             logger.info(f"Found auth session for {chat_id}")
-            return {
-                'state': session_data['state'],
-                'timestamp': datetime.fromisoformat(session_data['timestamp'])
-            }
-        logger.info(f"No auth session found for {chat_id}")
+        else:
+            logger.info(f"No auth session found for {chat_id}")
+        return session
+    except Exception as e:
+        logger.error(f"Error getting auth session for {chat_id}: {str(e)}")
         return None
+
+async def get_auth_session_async(chat_id):
+    """Get an auth session without blocking the event loop"""
+    try:
+        key = f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"
+        session = _get_cached(key)
+        if session is not MISS:
+            return session
+        logger.info(f"Getting auth session for {chat_id}")
+        session = await get_storage().get_auth_session_async(chat_id)
+        _set_cached(key, session)
+        if session:
+            logger.info(f"Found auth session for {chat_id}")
+        else:
+            logger.info(f"No auth session found for {chat_id}")
+        return session
     except Exception as e:
         logger.error(f"Error getting auth session for {chat_id}: {str(e)}")
         return None
 
 def remove_auth_session(chat_id):
-    """Remove an auth session from Redis"""
+    """Remove an auth session"""
     try:
-        key = f"{AUTH_SESSION_KEY_PREFIX}{chat_id}"
-        logger.info(f"Removing auth session from Redis with key: {key}")
-        redis_client.delete(key)
+        logger.info(f"Removing auth session for {chat_id}")
+        get_storage().remove_auth_session(chat_id)
+        _invalidate(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}")
+        logger.info(f"Successfully removed auth session for {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error removing auth session for {chat_id}: {str(e)}")
+        return False
+
+async def remove_auth_session_async(chat_id):
+    """Remove an auth session without blocking the event loop"""
+    try:
+        logger.info(f"Removing auth session for {chat_id}")
+        await get_storage().remove_auth_session_async(chat_id)
+        await _invalidate_async(f"{AUTH_SESSION_KEY_PREFIX}{chat_id}")
         logger.info(f"Successfully removed auth session for {chat_id}")
         return True
     except Exception as e:
@@ -139,5 +855,50 @@ def remove_auth_session(chat_id):
         return False
 
 def cleanup_expired_sessions():
-    """Cleanup is handled automatically by Redis TTL"""
-    pass 
\ No newline at end of file
+    """Delete expired auth sessions (Redis expires them by itself)"""
+    try:
+        swept = get_storage().cleanup_expired_sessions()
+        if swept:
+            logger.info(f"Swept {swept} expired auth sessions")
+        return swept
+    except Exception as e:
+        logger.error(f"Error sweeping expired auth sessions: {str(e)}")
+        return 0
+
+async def acquire_lock_async(name, token, ttl_ms):
+    """Take a lock shared by all processes for up to `ttl_ms`
+
+    Returns True if taken, False if someone else holds it and None if the
+    lock couldn't be checked.
+    """
+    try:
+        return await get_storage().acquire_lock_async(name, token, ttl_ms)
+    except Exception as e:
+        logger.error(f"Error acquiring lock {name}: {str(e)}")
+        return None
+
+async def is_locked_async(name):
+    """Check whether someone holds a lock, assuming not if it can't be checked"""
+    try:
+        return await get_storage().is_locked_async(name)
+    except Exception as e:
+        logger.error(f"Error checking lock {name}: {str(e)}")
+        return False
+
+async def release_lock_async(name, token):
+    """Release a lock taken with acquire_lock_async"""
+    try:
+        await get_storage().release_lock_async(name, token)
+        return True
+    except Exception as e:
+        logger.error(f"Error releasing lock {name}: {str(e)}")
+        return False
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the Redis data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('backfill', help='Index users stored before the users set and indexes existed')
+    args = parser.parse_args()
+
+    if args.command == 'backfill':
+        print(f"Indexed {backfill_user_indexes()} users")
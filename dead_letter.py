@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import database
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Redis list of failed work, newest first
+DEAD_LETTER_KEY = 'dead_letter'
+DEAD_LETTER_MAX_ENTRIES = int(os.getenv('DEAD_LETTER_MAX_ENTRIES', '10000'))
+
+# Kinds of dead letters and the payload each carries
+ACTIVITY = 'activity'              # {'chat_id', 'activity'}: a cheer that could not be sent
+ACTIVITY_CHECK = 'activity_check'  # {'chat_id'}: a user's activities could not be fetched
+STRAVA_EVENT = 'strava_event'      # {'event'}: a push event that could not be handled
+
+def _queue_add(pipe, kind, payload, error):
+    entry = {
+        'kind': kind,
+        'payload': payload,
+        'error': str(error),
+        'failed_at': int(time.time())
+    }
+    pipe.lpush(DEAD_LETTER_KEY, json.dumps(entry))
+    pipe.ltrim(DEAD_LETTER_KEY, 0, DEAD_LETTER_MAX_ENTRIES - 1)
+
+def add(kind, payload, error):
+    """Record work that failed after all retries so it can be replayed later"""
+    if not database.uses_redis():
+        logger.error(f"Giving up on {kind} {payload}, dead letters need Redis: {str(error)}")
+        return
+    try:
+        pipe = database.get_redis().pipeline()
+        _queue_add(pipe, kind, payload, error)
+        pipe.execute()
+        logger.warning(f"Dead-lettered {kind} {payload}: {str(error)}")
+    except Exception as e:
+        logger.error(f"Error dead-lettering {kind} {payload}: {str(e)}")
+
+async def add_async(kind, payload, error):
+    """Like add, without blocking the event loop"""
+    if not database.uses_redis():
+        logger.error(f"Giving up on {kind} {payload}, dead letters need Redis: {str(error)}")
+        return
+    try:
+        pipe = database.get_async_redis().pipeline()
+        _queue_add(pipe, kind, payload, error)
+        await pipe.execute()
+        logger.warning(f"Dead-lettered {kind} {payload}: {str(error)}")
+    except Exception as e:
+        logger.error(f"Error dead-lettering {kind} {payload}: {str(e)}")
+
+def list_entries(limit=100):
+    """Get the oldest dead letters first"""
+    return [json.loads(raw) for raw in reversed(database.get_redis().lrange(DEAD_LETTER_KEY, -limit, -1))]
+
+async def _replay_entry(bot, entry):
+    # Imported here since main itself dead-letters its failures
+    from main import check_activities_for_user, notify_activity
+    import strava_events
+
+    payload = entry['payload']
+    if entry['kind'] == ACTIVITY:
+        # The notified ledger keeps this from cheering an activity that was sent meanwhile
+        await notify_activity(bot, payload['chat_id'], payload['activity'])
+    elif entry['kind'] == ACTIVITY_CHECK:
+        await check_activities_for_user(payload['chat_id'], bot)
+    elif entry['kind'] == STRAVA_EVENT:
+        await strava_events.handle_event(payload['event'], bot=bot)
+    else:
+        logger.error(f"Unknown dead letter kind {entry['kind']}, dropping it")
+
+async def replay(limit=100):
+    """Replay the oldest dead letters, returning how many were replayed
+
+    Entries are taken off the list before they are replayed; work that fails
+    again is dead-lettered anew by the code it runs through.
+    """
+    from main import get_bot
+    import strava_client
+    import telegram_outbox
+
+    replayed = 0
+    # Only what is queued now, so entries failing again aren't replayed twice
+    count = min(limit, database.get_redis().llen(DEAD_LETTER_KEY))
+    async with get_bot() as bot:
+        try:
+            for _ in range(count):
+                raw = database.get_redis().rpop(DEAD_LETTER_KEY)
+                if raw is None:
+                    break
+                entry = json.loads(raw)
+                logger.info(f"Replaying {entry['kind']} {entry['payload']}")
+                try:
+                    await _replay_entry(bot, entry)
+                    replayed += 1
+                except Exception as e:
+                    logger.exception(f"Error replaying {entry['kind']} {entry['payload']}: {str(e)}")
+                    database.get_redis().rpush(DEAD_LETTER_KEY, raw)
+                    break
+        finally:
+            await telegram_outbox.close()
+            await strava_client.close()
+            await database.close_async_redis()
+    return replayed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect and replay failed sends and fetches')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show = subparsers.add_parser('list', help='Show the oldest dead letters')
+    show.add_argument('--limit', type=int, default=100)
+    rerun = subparsers.add_parser('replay', help='Replay the oldest dead letters')
+    rerun.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        print(f"{database.get_redis().llen(DEAD_LETTER_KEY)} dead letters")
+        for entry in list_entries(args.limit):
+            print(f"{entry['failed_at']} {entry['kind']} {json.dumps(entry['payload'])[:200]} ({entry['error']})")
+    elif args.command == 'replay':
+        print(f"Replayed {asyncio.run(replay(args.limit))} dead letters")
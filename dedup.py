@@ -0,0 +1,154 @@
+import os
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+import database
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Key prefix for processed update markers
+PROCESSED_UPDATE_KEY_PREFIX = 'processed_update:'
+
+# Telegram keeps undelivered updates for 24 hours, so markers never need to outlive that
+UPDATE_DEDUP_TTL = int(os.getenv('UPDATE_DEDUP_TTL', '86400'))
+UPDATE_DEDUP_CACHE_SIZE = int(os.getenv('UPDATE_DEDUP_CACHE_SIZE', '10000'))
+# Processing markers are refreshed while the handlers run and expire this long
+# after their process stops, so a redelivery can take the update over
+UPDATE_PROCESSING_TTL = int(os.getenv('UPDATE_PROCESSING_TTL', '30'))
+# How often a resumed update checks whether its current owner is done or gone
+MARKER_POLL_SECONDS = 1
+
+PROCESSING = 'processing'
+DONE = 'done'
+
+# Extend a processing marker, but only while it still belongs to this owner
+REFRESH_MARKER_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class UpdateDeduplicator:
+    """Detect redelivered Telegram updates by update_id
+
+    An update is claimed with a short-lived "processing" marker in Redis (SET
+    NX) before its handlers run and marked "done" for `ttl` once they finish.
+    The claiming task refreshes its marker every third of `processing_ttl`
+    while it runs, so a slow update stays claimed, while a process dying
+    mid-update only holds the update until its marker expires. A bounded in-process LRU of done updates answers repeats
+    seen by this process without a round trip. Without Redis, duplicates are
+    only caught within this process.
+    """
+
+    def __init__(self, max_size=UPDATE_DEDUP_CACHE_SIZE, ttl=UPDATE_DEDUP_TTL, processing_ttl=UPDATE_PROCESSING_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.processing_ttl = processing_ttl
+        self._done = OrderedDict()
+        # Updates in progress here, standing in for the markers without Redis
+        self._processing = set()
+        self._heartbeats = {}
+        self._lock = threading.Lock()
+
+    def _remember(self, update_id):
+        with self._lock:
+            self._done[update_id] = True
+            self._done.move_to_end(update_id)
+            while len(self._done) > self.max_size:
+                self._done.popitem(last=False)
+
+    def _done_recently(self, update_id):
+        with self._lock:
+            if update_id in self._done:
+                self._done.move_to_end(update_id)
+                return True
+            return False
+
+    async def _refresh_marker(self, key, marker):
+        while True:
+            await asyncio.sleep(self.processing_ttl / 3)
+            try:
+                if not await database.get_async_redis().eval(REFRESH_MARKER_SCRIPT, 1, key, marker, self.processing_ttl):
+                    logger.warning(f"Processing marker {key} was taken over, no longer refreshing it")
+                    return
+            except Exception as e:
+                logger.error(f"Error refreshing processing marker {key}: {str(e)}")
+
+    def _stop_heartbeat(self, update_id):
+        heartbeat = self._heartbeats.pop(update_id, None)
+        if heartbeat is not None:
+            heartbeat.cancel()
+
+    def _start_heartbeat(self, update_id, key, marker):
+        self._heartbeats[update_id] = asyncio.create_task(self._refresh_marker(key, marker))
+        # Stop refreshing once the claiming task ends, even if it never calls finish_async
+        owner = asyncio.current_task()
+        if owner is not None:
+            owner.add_done_callback(lambda done: self._stop_heartbeat(update_id))
+
+    async def begin_async(self, update_id, resume=False):
+        """Claim an update for processing, returning False if it is a duplicate
+
+        `resume` is for redeliveries of updates this bot itself failed to
+        finish (stream entries claimed from a dead worker, updates fetched
+        again after a polling crash): instead of skipping an update that is
+        still marked as processing, they wait until its owner either finishes
+        it (then skip it) or stops refreshing the marker (then take it over).
+        """
+        if self._done_recently(update_id):
+            return False
+        if not database.uses_redis():
+            # The owner is this process, which is still running it
+            with self._lock:
+                if update_id in self._processing:
+                    return False
+                self._processing.add(update_id)
+            owner = asyncio.current_task()
+            if owner is not None:
+                owner.add_done_callback(lambda done: self._processing.discard(update_id))
+            return True
+
+        try:
+            client = database.get_async_redis()
+            key = f"{PROCESSED_UPDATE_KEY_PREFIX}{update_id}"
+            marker = f"{PROCESSING}:{uuid.uuid4().hex}"
+            while True:
+                if await client.set(key, marker, nx=True, ex=self.processing_ttl):
+                    self._start_heartbeat(update_id, key, marker)
+                    return True
+                state = await client.get(key)
+                if state == DONE:
+                    self._remember(update_id)
+                    return False
+                if not resume:
+                    return False
+                await asyncio.sleep(MARKER_POLL_SECONDS)
+        except Exception as e:
+            # Processing a rare duplicate is better than dropping updates while Redis is down
+            logger.error(f"Error checking update {update_id} for duplicates: {str(e)}")
+            return True
+
+    async def finish_async(self, update_id):
+        """Mark an update as done once its handlers have finished"""
+        self._remember(update_id)
+        self._stop_heartbeat(update_id)
+        if not database.uses_redis():
+            with self._lock:
+                self._processing.discard(update_id)
+            return
+        try:
+            key = f"{PROCESSED_UPDATE_KEY_PREFIX}{update_id}"
+            await database.get_async_redis().set(key, DONE, ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Error marking update {update_id} as done: {str(e)}")
+
+# Shared deduplicator for the process
+deduplicator = UpdateDeduplicator()
@@ -0,0 +1,70 @@
+import os
+import asyncio
+import logging
+from main import process_update
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Maximum number of chats processed at the same time
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', '16'))
+
+def get_update_chat_id(update):
+    """Get the chat an update belongs to, or None if it has no chat"""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if field in update:
+            return update[field].get('chat', {}).get('id')
+    callback_query = update.get('callback_query')
+    if callback_query and 'message' in callback_query:
+        return callback_query['message'].get('chat', {}).get('id')
+    return None
+
+class ChatDispatcher:
+    """Run updates through process_update, ordered per chat and concurrent across chats
+
+    Each submitted update waits for the previous update of the same chat to
+    finish before it runs, so e.g. /connect and the following auth code can't
+    race on the auth session. At most `concurrency` updates run at once.
+    """
+
+    def __init__(self, bot, concurrency=DISPATCH_CONCURRENCY):
+        self.bot = bot
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails = {}
+
+    async def _run(self, previous, update, resume):
+        if previous is not None:
+            # Only ordering matters here, the previous update handles its own errors
+            await asyncio.gather(previous, return_exceptions=True)
+        async with self._slots:
+            await process_update(update, bot=self.bot, resume=resume)
+
+    def _release_tail(self, chat_id, task):
+        if self._tails.get(chat_id) is task:
+            del self._tails[chat_id]
+
+    def submit(self, update, resume=False):
+        """Schedule an update and return the task processing it"""
+        chat_id = get_update_chat_id(update)
+        if chat_id is None:
+            return asyncio.create_task(self._run(None, update, resume))
+
+        chat_id = str(chat_id)
+        task = asyncio.create_task(self._run(self._tails.get(chat_id), update, resume))
+        self._tails[chat_id] = task
+        task.add_done_callback(lambda done: self._release_tail(chat_id, done))
+        return task
+
+    async def dispatch_batch(self, updates, resume=False):
+        """Process a batch of updates and wait for all of them"""
+        tasks = [self.submit(update, resume) for update in updates]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def pending_chats(self):
+        """Number of chats with updates queued or running"""
+        return len(self._tails)
@@ -0,0 +1,178 @@
+from flask import Flask, request, jsonify
+import time
+import uuid
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+import httpx
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Local stand-in for the Strava API and its push events. Point the bot at it with
+# STRAVA_API_URL=http://localhost:<port>/api/v3 and STRAVA_TOKEN_URL=http://localhost:<port>/oauth/token
+app = Flask(__name__)
+
+FAKE_SUBSCRIPTION_ID = 1
+TOKEN_LIFETIME_SECONDS = 6 * 60 * 60
+
+_lock = threading.Lock()
+_tokens = {}        # access token -> athlete ID
+_refresh_tokens = {}  # refresh token -> athlete ID
+_activities = {}    # activity ID -> activity
+_subscription = {}
+
+def _issue_tokens(athlete_id):
+    access_token = uuid.uuid4().hex
+    refresh_token = uuid.uuid4().hex
+    with _lock:
+        _tokens[access_token] = athlete_id
+        _refresh_tokens[refresh_token] = athlete_id
+    return {
+        'token_type': 'Bearer',
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_at': int(time.time()) + TOKEN_LIFETIME_SECONDS,
+        'expires_in': TOKEN_LIFETIME_SECONDS
+    }
+
+def _authorized_athlete():
+    """Get the athlete of the request's bearer token, or None"""
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    with _lock:
+        return _tokens.get(token)
+
+def _post_event(event):
+    """Post an event to the subscribed callback, like Strava does"""
+    callback_url = _subscription.get('callback_url')
+    if not callback_url:
+        logger.warning(f"No push subscription, dropping event {event}")
+        return None
+    event = dict(event, event_time=int(time.time()), subscription_id=FAKE_SUBSCRIPTION_ID)
+    response = httpx.post(callback_url, json=event, timeout=10)
+    logger.info(f"Posted {event['object_type']} event {event['object_id']} to {callback_url}: {response.status_code}")
+    return response.status_code
+
+@app.route('/oauth/token', methods=['POST'])
+def token():
+    """Exchange an authorization code (the athlete ID, for simplicity) or a refresh token"""
+    if request.form.get('grant_type') == 'refresh_token':
+        with _lock:
+            athlete_id = _refresh_tokens.pop(request.form.get('refresh_token'), None)
+        if athlete_id is None:
+            return jsonify({'message': 'Bad Request', 'errors': [{'field': 'refresh_token', 'code': 'invalid'}]}), 400
+        return jsonify(_issue_tokens(athlete_id))
+
+    code = request.form.get('code', '')
+    if not code.isdigit():
+        return jsonify({'message': 'Bad Request', 'errors': [{'field': 'code', 'code': 'invalid'}]}), 400
+    athlete_id = int(code)
+    return jsonify(dict(_issue_tokens(athlete_id), athlete={'id': athlete_id, 'firstname': 'Fake', 'lastname': f'Athlete {athlete_id}'}))
+
+@app.route('/api/v3/athlete', methods=['GET'])
+def athlete():
+    athlete_id = _authorized_athlete()
+    if athlete_id is None:
+        return jsonify({'message': 'Authorization Error'}), 401
+    return jsonify({'id': athlete_id, 'firstname': 'Fake', 'lastname': f'Athlete {athlete_id}'})
+
+@app.route('/api/v3/athlete/activities', methods=['GET'])
+def athlete_activities():
+    athlete_id = _authorized_athlete()
+    if athlete_id is None:
+        return jsonify({'message': 'Authorization Error'}), 401
+    after = int(request.args.get('after', 0))
+    page = int(request.args.get('page', 1))
+    per_page = int(request.args.get('per_page', 30))
+    with _lock:
+        activities = [
+            activity for activity in _activities.values()
+            if activity['athlete']['id'] == athlete_id and activity['_start_ts'] > after
+        ]
+    activities.sort(key=lambda activity: activity['_start_ts'], reverse=True)
+    page_items = activities[(page - 1) * per_page:page * per_page]
+    return jsonify([{k: v for k, v in activity.items() if not k.startswith('_')} for activity in page_items])
+
+@app.route('/api/v3/activities/<int:activity_id>', methods=['GET'])
+def activity(activity_id):
+    athlete_id = _authorized_athlete()
+    if athlete_id is None:
+        return jsonify({'message': 'Authorization Error'}), 401
+    with _lock:
+        found = _activities.get(activity_id)
+    if not found or found['athlete']['id'] != athlete_id:
+        return jsonify({'message': 'Record Not Found'}), 404
+    return jsonify({k: v for k, v in found.items() if not k.startswith('_')})
+
+@app.route('/api/v3/push_subscriptions', methods=['POST'])
+def create_subscription():
+    """Validate the callback with a challenge, as Strava does, then subscribe it"""
+    callback_url = request.form.get('callback_url')
+    challenge = uuid.uuid4().hex
+    try:
+        response = httpx.get(callback_url, params={
+            'hub.mode': 'subscribe',
+            'hub.verify_token': request.form.get('verify_token'),
+            'hub.challenge': challenge
+        }, timeout=10)
+        valid = response.status_code == 200 and response.json().get('hub.challenge') == challenge
+    except (httpx.HTTPError, ValueError):
+        valid = False
+    if not valid:
+        return jsonify({'message': 'Bad Request', 'errors': [{'field': 'callback url', 'code': 'GET to callback URL does not return 200'}]}), 400
+    _subscription.update(id=FAKE_SUBSCRIPTION_ID, callback_url=callback_url)
+    return jsonify({'id': FAKE_SUBSCRIPTION_ID})
+
+@app.route('/api/v3/push_subscriptions', methods=['GET'])
+def view_subscription():
+    return jsonify([_subscription] if _subscription else [])
+
+@app.route('/api/v3/push_subscriptions/<int:subscription_id>', methods=['DELETE'])
+def delete_subscription(subscription_id):
+    if _subscription.get('id') != subscription_id:
+        return jsonify({'message': 'Record Not Found'}), 404
+    _subscription.clear()
+    return '', 204
+
+@app.route('/fake/activities', methods=['POST'])
+def create_activity():
+    """Record an activity for an athlete and push its create event"""
+    data = request.get_json(silent=True) or request.form
+    athlete_id = int(data['owner_id'])
+    now = datetime.now(timezone.utc)
+    with _lock:
+        activity_id = max(_activities, default=1000) + 1
+        _activities[activity_id] = {
+            'id': activity_id,
+            'athlete': {'id': athlete_id},
+            'name': data.get('name', 'Morning Run'),
+            'type': data.get('type', 'Run'),
+            'moving_time': int(data.get('moving_time', 1800)),
+            'distance': float(data.get('distance', 5000)),
+            'start_date': now.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            '_start_ts': int(now.timestamp())
+        }
+    status = _post_event({'object_type': 'activity', 'object_id': activity_id, 'aspect_type': 'create', 'owner_id': athlete_id, 'updates': {}})
+    return jsonify({'id': activity_id, 'callback_status': status})
+
+@app.route('/fake/deauthorize', methods=['POST'])
+def deauthorize():
+    """Push the event Strava sends when an athlete revokes access"""
+    data = request.get_json(silent=True) or request.form
+    athlete_id = int(data['owner_id'])
+    status = _post_event({'object_type': 'athlete', 'object_id': athlete_id, 'aspect_type': 'update', 'owner_id': athlete_id, 'updates': {'authorized': 'false'}})
+    return jsonify({'callback_status': status})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake Strava API that posts push events')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--callback-url', help='Subscribe this /strava/webhook URL right away, without validation')
+    args = parser.parse_args()
+    if args.callback_url:
+        _subscription.update(id=FAKE_SUBSCRIPTION_ID, callback_url=args.callback_url)
+    app.run(host='127.0.0.1', port=args.port, threaded=True)
@@ -0,0 +1,63 @@
+import os
+import logging
+import threading
+import httpx
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Upstreams with their own connection pool
+STRAVA = 'strava'
+
+# Pool and timeout settings shared by all upstream clients
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+HTTP2_ENABLED = os.getenv('HTTP2_ENABLED', 'false').lower() == 'true'
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def use_http2():
+    """Check whether clients should use HTTP/2"""
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("HTTP2_ENABLED is set but the h2 package is not installed, using HTTP/1.1")
+        return False
+
+def get_client(upstream):
+    """Get the shared keep-alive HTTP client for an upstream, creating it on first use"""
+    with _clients_lock:
+        client = _clients.get(upstream)
+        if client is None:
+            http2 = use_http2()
+            logger.info(f"Creating HTTP client for {upstream} (pool size {HTTP_POOL_SIZE}, HTTP/2 {'on' if http2 else 'off'})")
+            client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=HTTP_POOL_SIZE,
+                    max_keepalive_connections=HTTP_POOL_SIZE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                http2=http2
+            )
+            _clients[upstream] = client
+        return client
+
+def close_clients():
+    """Close all shared clients and their connections"""
+    with _clients_lock:
+        for upstream, client in _clients.items():
+            client.close()
+            logger.info(f"Closed HTTP client for {upstream}")
+        _clients.clear()
@@ -1,15 +1,25 @@
 import os
-import requests
+import html
+import httpx
 import time
 import logging
 import random
 import tracemalloc
 import asyncio
+import argparse
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from strava_auth import get_strava_header, exchange_code_for_token, get_authorization_url, refresh_access_token
+from strava_auth import get_strava_header, get_authorization_url
 import database
+import strava_client
+import token_refresher
+import telegram_outbox
+import retry
+import dead_letter
+from circuit_breaker import CircuitOpenError
+from dedup import deduplicator
 import telegram
+from telegram.request import HTTPXRequest
 
 # Enable tracemalloc
 tracemalloc.start()
@@ -35,8 +45,26 @@ STRAVA_REDIRECT_URI = os.getenv('STRAVA_REDIRECT_URI')
 # Log loaded environment variables (excluding secrets)
 logger.info(f"Loaded environment variables - Client ID: {STRAVA_CLIENT_ID}, Redirect URI: {STRAVA_REDIRECT_URI}")
 
+# Size of the HTTP connection pool used by the shared Telegram bot
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '32'))
+# How far back to look for activities of users that haven't been checked before
+ACTIVITY_INITIAL_LOOKBACK_HOURS = int(os.getenv('ACTIVITY_INITIAL_LOOKBACK_HOURS', '12'))
+# Number of users checked in parallel by the periodic activity check
+ACTIVITY_CHECK_CONCURRENCY = int(os.getenv('ACTIVITY_CHECK_CONCURRENCY', '8'))
+# Users loaded from Redis in one round trip by the periodic activity check
+ACTIVITY_CHECK_BATCH_SIZE = int(os.getenv('ACTIVITY_CHECK_BATCH_SIZE', '100'))
+# 'messages' sends a greeting, one message per activity and a sign-off;
+# 'digest' sends all new activities of a run in a single message
+NOTIFICATION_MODE = os.getenv('NOTIFICATION_MODE', 'messages').lower()
+# Telegram rejects longer messages
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Retries for Telegram network errors (429s are already retried by the outbox);
+# a message may have been sent despite a read timeout, so those aren't retried
+TELEGRAM_RETRY_POLICY = retry.RetryPolicy(idempotent=False, retry_after=False)
+
 # Global variables
 auth_sessions = {}
+_bot = None
 
 # List of inspirational messages
 INSPIRATIONAL_MESSAGES = [
@@ -145,7 +173,8 @@ To get started:
 
 Use /help to see all available commands.
 """
-        await bot.send_message(
+        await telegram_outbox.send_message(
+            bot,
             chat_id=chat_id,
             text=message,
             parse_mode='Markdown'
@@ -155,7 +184,8 @@ Use /help to see all available commands.
     except Exception as e:
         logger.error(f"Error in handle_start: {str(e)}")
         if 'bot' in locals() and 'chat_id' in locals():
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error processing your request. Please try again later."
             )
@@ -185,7 +215,8 @@ async def handle_help(bot, update):
 *Need Help?*
 If you encounter any issues, try disconnecting and reconnecting your account using /disconnect and /connect.
 """
-        await bot.send_message(
+        await telegram_outbox.send_message(
+            bot,
             chat_id=chat_id,
             text=help_text,
             parse_mode='Markdown'
@@ -195,7 +226,8 @@ If you encounter any issues, try disconnecting and reconnecting your account usi
     except Exception as e:
         logger.error(f"Error in handle_help: {str(e)}")
         if 'bot' in locals() and 'chat_id' in locals():
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error showing the help message. Please try again later."
             )
@@ -207,20 +239,22 @@ async def handle_connect(bot, update):
         logger.info(f"Handling connect command for chat_id {chat_id}")
 
         # Check if user has an active session
-        session = database.get_auth_session(chat_id)
+        session = await database.get_auth_session_async(chat_id)
         if session:
             logger.info(f"User {chat_id} has an active session: {session}")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="You already have an active authorization session. Please complete the current authorization process or wait for it to expire."
             )
             return
 
         # Check if user is already connected
-        user = database.get_user(chat_id)
+        user = await database.get_user_async(chat_id)
         if user:
             logger.info(f"User {chat_id} is already connected")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="You are already connected to Strava. Use /disconnect to remove the connection first."
             )
@@ -230,7 +264,8 @@ async def handle_connect(bot, update):
         auth_url = get_authorization_url()
         if not auth_url:
             logger.error("Failed to generate authorization URL")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error generating the authorization URL. Please try again later."
             )
@@ -241,16 +276,18 @@ async def handle_connect(bot, update):
         timestamp = datetime.now()
         logger.info(f"Creating auth session for {chat_id} with state {state} at {timestamp}")
         
-        if not database.add_auth_session(chat_id, state, timestamp):
+        if not await database.add_auth_session_async(chat_id, state, timestamp):
             logger.error(f"Failed to create auth session for {chat_id}")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error creating your authorization session. Please try again later."
             )
             return
 
         # Send authorization URL to user
-        await bot.send_message(
+        await telegram_outbox.send_message(
+            bot,
             chat_id=chat_id,
             text=f"Please click the link below to authorize the bot to access your Strava account:\n\n{auth_url}\n\nAfter authorizing, you'll be redirected to a page with an authorization code. Copy that code and send it back to me."
         )
@@ -259,7 +296,8 @@ async def handle_connect(bot, update):
     except Exception as e:
         logger.error(f"Error in handle_connect: {str(e)}")
         if 'bot' in locals() and 'chat_id' in locals():
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error processing your request. Please try again later."
             )
@@ -271,26 +309,29 @@ async def handle_disconnect(bot, update):
         logger.info(f"Handling disconnect command for chat_id {chat_id}")
 
         # Check if user is connected
-        user = database.get_user(chat_id)
+        user = await database.get_user_async(chat_id)
         if not user:
             logger.info(f"User {chat_id} is not connected")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="You are not connected to Strava. Use /connect to connect your account."
             )
             return
 
         # Remove user data
-        if not database.remove_user(chat_id):
+        if not await database.remove_user_async(chat_id):
             logger.error(f"Failed to remove user data for {chat_id}")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error disconnecting your account. Please try again later."
             )
             return
 
         # Send success message
-        await bot.send_message(
+        await telegram_outbox.send_message(
+            bot,
             chat_id=chat_id,
             text="✅ Successfully disconnected from Strava. Use /connect to connect your account again."
         )
@@ -299,7 +340,8 @@ async def handle_disconnect(bot, update):
     except Exception as e:
         logger.error(f"Error in handle_disconnect: {str(e)}")
         if 'bot' in locals() and 'chat_id' in locals():
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error processing your request. Please try again later."
             )
@@ -311,10 +353,11 @@ async def handle_status(bot, update):
         logger.info(f"Handling status command for chat_id {chat_id}")
 
         # Check if user is connected
-        user = database.get_user(chat_id)
+        user = await database.get_user_async(chat_id)
         if not user:
             logger.info(f"User {chat_id} is not connected")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="You are not connected to Strava. Use /connect to connect your account."
             )
@@ -326,14 +369,16 @@ async def handle_status(bot, update):
         # Check if token has expired
         if datetime.now() >= expires_at:
             logger.info(f"Token expired for user {chat_id}")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Your Strava connection has expired. Use /connect to reconnect your account."
             )
             return
 
         # Send status message
-        await bot.send_message(
+        await telegram_outbox.send_message(
+            bot,
             chat_id=chat_id,
             text="✅ Your Strava account is connected and active."
         )
@@ -342,7 +387,8 @@ async def handle_status(bot, update):
     except Exception as e:
         logger.error(f"Error in handle_status: {str(e)}")
         if 'bot' in locals() and 'chat_id' in locals():
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error checking your status. Please try again later."
             )
@@ -355,10 +401,11 @@ async def handle_auth_code(bot, update):
         logger.info(f"Handling auth code for chat_id {chat_id}")
 
         # Check if user has an active session
-        session = database.get_auth_session(chat_id)
+        session = await database.get_auth_session_async(chat_id)
         if not session:
             logger.info(f"No active session found for {chat_id}")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="No active authorization session found. Please use /connect to start the authorization process."
             )
@@ -367,37 +414,41 @@ async def handle_auth_code(bot, update):
         # Check if session has expired
         if datetime.now() - session['timestamp'] > timedelta(minutes=5):
             logger.info(f"Session expired for {chat_id}")
-            database.remove_auth_session(chat_id)
-            await bot.send_message(
+            await database.remove_auth_session_async(chat_id)
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Your authorization session has expired. Please use /connect to start a new session."
             )
             return
 
         # Exchange code for tokens
-        tokens = exchange_code_for_token(code)
+        tokens = await strava_client.exchange_code_for_token(code)
         if not tokens:
             logger.error(f"Failed to exchange code for tokens for {chat_id}")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error exchanging the authorization code. Please try again with /connect."
             )
             return
 
         # Store user data
-        if not database.add_user(chat_id, tokens['access_token'], tokens['refresh_token'], tokens['expires_at']):
+        if not await database.add_user_async(chat_id, tokens['access_token'], tokens['refresh_token'], tokens['expires_at'], tokens.get('athlete_id')):
             logger.error(f"Failed to store user data for {chat_id}")
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error storing your connection. Please try again with /connect."
             )
             return
 
         # Clean up session
-        database.remove_auth_session(chat_id)
+        await database.remove_auth_session_async(chat_id)
 
         # Send success message
-        await bot.send_message(
+        await telegram_outbox.send_message(
+            bot,
             chat_id=chat_id,
             text="✅ Successfully connected to Strava! You can now use the bot to interact with your Strava account."
         )
@@ -406,44 +457,21 @@ async def handle_auth_code(bot, update):
     except Exception as e:
         logger.error(f"Error in handle_auth_code: {str(e)}")
         if 'bot' in locals() and 'chat_id' in locals():
-            await bot.send_message(
+            await telegram_outbox.send_message(
+                bot,
                 chat_id=chat_id,
                 text="Sorry, there was an error processing your authorization code. Please try again with /connect."
             )
 
-def send_telegram_message(message, chat_id):
-    """Send a message to Telegram bot"""
-    if not TELEGRAM_BOT_TOKEN:
-        logger.error("Telegram bot token not found in .env file")
-        return False
-        
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    data = {
-        "chat_id": chat_id,
-        "text": message,
-        "parse_mode": "HTML"
-    }
+async def send_html_message(bot, chat_id, text):
+    """Send an HTML message with the async bot, returning whether it was delivered"""
     try:
-        response = requests.post(url, data=data)
-        response.raise_for_status()
+        await TELEGRAM_RETRY_POLICY.run(telegram_outbox.send_message, bot, chat_id, text, parse_mode='HTML')
         return True
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending Telegram message: {str(e)}")
+    except (telegram.error.TelegramError, CircuitOpenError) as e:
+        logger.error(f"Error sending Telegram message to {chat_id}: {str(e)}")
         return False
 
-def get_activities(access_token, after_ts):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    try:
-        response = requests.get(
-            f"https://www.strava.com/api/v3/activities?after={after_ts}",
-            headers=headers
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching activities: {str(e)}")
-        return None
-
 def get_activity_emoji(activity_type):
     """Get the appropriate emoji based on activity type"""
     emoji_map = {
@@ -484,103 +512,261 @@ def get_activity_emoji(activity_type):
     }
     return emoji_map.get(activity_type, '🏃')  # Default to running emoji if type not found
 
-def process_activities_for_user(chat_id):
-    """Process activities for a specific user (suitable for a periodic job)."""
-    try:
-        logger.info(f"Periodic check: Attempting to process activities for user {chat_id}.")
-        user = database.get_user(chat_id) # Fetches from Redis, returns a dict or None
+def format_activity_message(activity):
+    """Format the cheer message for a single activity"""
+    activity_name = activity.get('name', 'Unnamed Activity')
+    activity_type = activity.get('type', 'Unknown')
+    duration_seconds = activity.get('moving_time', 0)
+    duration_minutes = round(duration_seconds / 60, 2)
+    
+    emoji = get_activity_emoji(activity_type)
+    cheer = get_random_cheer().format(name=html.escape(activity_name))
+    
+    return f"{emoji} <b>{cheer}</b> {duration_minutes} minutes well spent!"
+
+def render_digest(activities):
+    """Render activities into digest messages that fit Telegram's size limit
+    
+    Returns (text, activities) pairs, each with the activities its message
+    covers. Messages are only split between lines.
+    """
+    lines = [(get_random_greeting(), None)]
+    lines += [(format_activity_message(activity), activity) for activity in activities]
+    lines.append((f"Processed {len(activities)} activities. {get_random_signoff()}", None))
+
+    chunks = []
+    text, covered = '', []
+    for line, activity in lines:
+        if text and len(text) + 1 + len(line) > TELEGRAM_MESSAGE_LIMIT:
+            chunks.append((text, covered))
+            text, covered = '', []
+        text = f"{text}\n{line}" if text else line
+        if activity is not None:
+            covered.append(activity)
+    chunks.append((text, covered))
+    return chunks
+
+async def send_digest(bot, chat_id, activities):
+    """Send claimed activities as a digest, returning the number of messages sent
+    
+    The cursor advances past each delivered message. If a message fails, the
+    claims of its activities and of all later ones are released so they are
+    retried on the next run.
+    """
+    chunks = render_digest(activities)
+    for index, (text, covered) in enumerate(chunks):
+        if not await send_html_message(bot, str(chat_id), text):
+            logger.error(f"Failed to send activity digest to user {chat_id}. Stopping.")
+            for _, unsent in chunks[index:]:
+                for activity in unsent:
+                    await database.release_activity_notification_async(chat_id, activity.get('id'))
+            return index
+        if covered:
+            last = covered[-1]
+            await database.advance_activity_cursor_async(chat_id, get_activity_start_ts(last), last.get('id'))
+    return len(chunks)
+
+def get_activity_start_ts(activity):
+    """Get an activity's start time as a UTC epoch timestamp"""
+    start_date = activity.get('start_date')
+    if not start_date:
+        return 0
+    return int(datetime.fromisoformat(start_date.replace('Z', '+00:00')).timestamp())
+
+async def get_valid_access_token(bot, chat_id, user):
+    """Get a usable access token for a user, refreshing it if it expires soon
+    
+    Returns None (after telling the user if the refresh failed) when no valid
+    token is available.
+    """
+    # Gracefully access user data
+    access_token = user.get('access_token')
+    refresh_token = user.get('refresh_token')
+    expires_at = user.get('expires_at') # This should be a datetime object from database.get_user()
+
+    if not all([access_token, refresh_token, expires_at]):
+        logger.error(f"Token check: User {chat_id} data is incomplete. access_token: {'found' if access_token else 'missing'}, refresh_token: {'found' if refresh_token else 'missing'}, expires_at: {'found' if expires_at else 'missing'}. Skipping.")
+        return None
 
-        if not user:
-            logger.info(f"Periodic check: User {chat_id} not found or not connected. Skipping.")
-            return
+    # Ensure expires_at is a datetime object (it should be, but defensive check)
+    if not isinstance(expires_at, datetime):
+        logger.error(f"Token check: User {chat_id} expires_at is not a datetime object: {type(expires_at)}. Skipping.")
+        # Potentially try to parse it if it's a string, or log an error and return
+        return None
 
-        # Gracefully access user data
-        access_token = user.get('access_token')
-        refresh_token = user.get('refresh_token')
-        expires_at = user.get('expires_at') # This should be a datetime object from database.get_user()
 
-        if not all([access_token, refresh_token, expires_at]):
-            logger.error(f"Periodic check: User {chat_id} data is incomplete. access_token: {'found' if access_token else 'missing'}, refresh_token: {'found' if refresh_token else 'missing'}, expires_at: {'found' if expires_at else 'missing'}. Skipping.")
-            return
+    # Check if token has expired or will expire soon (e.g., within 15 minutes)
+    valid_until = datetime.now() + timedelta(minutes=15)
+    if expires_at <= valid_until:
+        logger.info(f"Token check: Token for user {chat_id} (expires at {expires_at}) is expired or expiring soon. Refreshing...")
+        
+        # Shares the refresh with any concurrent caller for the same user
+        refreshed_user = await token_refresher.refresh_user_token(chat_id, valid_until)
+
+        if refreshed_user and refreshed_user['expires_at'] > datetime.now():
+            access_token = refreshed_user['access_token'] # Use the new token for this run
+        else:
+            logger.error(f"Token check: Failed to refresh token for user {chat_id}. Notifying user.")
+            await send_html_message(
+                bot,
+                str(chat_id),
+                "⚠️ Your Strava connection needs to be refreshed, but it failed. Please try /disconnect and /connect again."
+            )
+            return None # Cannot proceed without a valid token
 
-        # Ensure expires_at is a datetime object (it should be, but defensive check)
-        if not isinstance(expires_at, datetime):
-            logger.error(f"Periodic check: User {chat_id} expires_at is not a datetime object: {type(expires_at)}. Skipping.")
-            # Potentially try to parse it if it's a string, or log an error and return
-            return
+    return access_token
 
+async def notify_activity(bot, chat_id, activity):
+    """Cheer a user for a single activity unless they were already notified about it"""
+    activity_id = activity.get('id')
+    claimed = await database.claim_activity_notification_async(chat_id, activity_id)
+    if not claimed:
+        return False
 
-        # Check if token has expired or will expire soon (e.g., within 15 minutes)
-        if datetime.now() >= expires_at - timedelta(minutes=15):
-            logger.info(f"Periodic check: Token for user {chat_id} (expires at {expires_at}) is expired or expiring soon. Refreshing...")
-            
-            new_tokens = refresh_access_token(refresh_token)
-
-            if new_tokens and 'access_token' in new_tokens and 'expires_in' in new_tokens:
-                logger.info(f"Periodic check: Successfully refreshed token for user {chat_id}.")
-                access_token = new_tokens['access_token'] # Use the new token for this run
-                
-                # Calculate new expiration datetime object
-                new_expires_at_timestamp = datetime.now().timestamp() + new_tokens['expires_in']
-                new_expires_at_datetime = datetime.fromtimestamp(new_expires_at_timestamp)
-                
-                # Update user data in Redis with new tokens and expiry
-                database.add_user(
-                    chat_id,
-                    new_tokens['access_token'],
-                    new_tokens.get('refresh_token', refresh_token), # Use new refresh token if Strava provides it
-                    new_expires_at_datetime # Pass the datetime object
-                )
-                expires_at = new_expires_at_datetime # Update expires_at for current run if needed, though not strictly necessary here
-            else:
-                logger.error(f"Periodic check: Failed to refresh token for user {chat_id}. Response: {new_tokens}. Notifying user.")
-                send_telegram_message(
-                    "⚠️ Your Strava connection needs to be refreshed, but it failed. Please try /disconnect and /connect again.",
-                    str(chat_id) # Ensure chat_id is a string if send_telegram_message expects it
-                )
-                return # Cannot proceed without a valid token
+    try:
+        await TELEGRAM_RETRY_POLICY.run(telegram_outbox.send_message, bot, str(chat_id), format_activity_message(activity), parse_mode='HTML')
+    except (telegram.error.TelegramError, CircuitOpenError) as e:
+        logger.error(f"Failed to notify user {chat_id} about activity {activity_id}: {str(e)}")
+        await database.release_activity_notification_async(chat_id, activity_id)
+        # Blocked bots and bad requests won't succeed on replay
+        if isinstance(e, CircuitOpenError) or TELEGRAM_RETRY_POLICY.is_retryable(e):
+            await dead_letter.add_async(dead_letter.ACTIVITY, {'chat_id': str(chat_id), 'activity': activity}, e)
+        return False
 
-        # Fetch activities from the last 12 hours
-        twelve_hours_ago = datetime.now() - timedelta(minutes=1)
-        after_ts = int(twelve_hours_ago.timestamp())
+    await database.advance_activity_cursor_async(chat_id, get_activity_start_ts(activity), activity_id)
+    logger.info(f"Notified user {chat_id} about activity {activity_id}")
+    return True
+
+async def check_activities_for_user(chat_id, bot, user=None):
+    """Process activities for a specific user (suitable for a periodic job).
+    
+    Batch callers pass the user record they already loaded. Returns a dict
+    with the number of activities found and messages sent.
+    """
+    stats = {'activities': 0, 'messages': 0}
+    try:
+        logger.info(f"Periodic check: Attempting to process activities for user {chat_id}.")
+        if user is None:
+            user = await database.get_user_async(chat_id) # Fetches from Redis, returns a dict or None
+
+        if not user:
+            logger.info(f"Periodic check: User {chat_id} not found or not connected. Skipping.")
+            return stats
+
+        access_token = await get_valid_access_token(bot, chat_id, user)
+        if not access_token:
+            return stats
+
+        # Users connected before push events were supported need their athlete ID recorded once
+        if not user.get('athlete_id'):
+            athlete = await strava_client.get_athlete(access_token)
+            if athlete and athlete.get('id'):
+                await database.set_user_athlete_async(chat_id, athlete['id'])
+
+        # Fetch only activities that started after the last one we cheered for
+        after_ts = user.get('last_activity_ts')
+        if after_ts is None:
+            lookback_start = datetime.now() - timedelta(hours=ACTIVITY_INITIAL_LOOKBACK_HOURS)
+            after_ts = int(lookback_start.timestamp())
         
         logger.info(f"Periodic check: Fetching activities for user {chat_id} after timestamp {after_ts}.")
-        activities = get_activities(access_token, after_ts) # Assumes get_activities is synchronous
-        
-        if activities is None: 
-            logger.error(f"Periodic check: Failed to fetch activities for user {chat_id}. An error occurred in get_activities.")
-            return
-        if not activities: 
-            logger.info(f"Periodic check: No new activities for user {chat_id} in the last 12 hours.")
-            return
-
-        logger.info(f"Periodic check: Found {len(activities)} new activities for user {chat_id}.")
-        send_telegram_message(get_random_greeting(), str(chat_id))
         
+        # Cheer each activity as soon as its page arrives, oldest first so the cursor only moves forward
         activity_count = 0
-        for activity in activities:
-            activity_name = activity.get('name', 'Unnamed Activity')
-            activity_type = activity.get('type', 'Unknown')
-            duration_seconds = activity.get('moving_time', 0)
-            duration_minutes = round(duration_seconds / 60, 2)
-            
-            emoji = get_activity_emoji(activity_type)
-            cheer = get_random_cheer().format(name=activity_name)
+        digest = []
+        try:
+            async for activity in strava_client.iter_activities(access_token, after_ts):
+                activity_id = activity.get('id')
+                if str(activity_id) == user.get('last_activity_id'):
+                    continue
+                stats['activities'] += 1
+
+                # Claim the activity in the notified ledger so overlapping runs never cheer twice
+                claimed = await database.claim_activity_notification_async(chat_id, activity_id)
+                if claimed is None:
+                    break
+                if not claimed:
+                    continue
+
+                if NOTIFICATION_MODE == 'digest':
+                    digest.append(activity)
+                    continue
+
+                if activity_count == 0 and await send_html_message(bot, str(chat_id), get_random_greeting()):
+                    stats['messages'] += 1
+
+                if not await send_html_message(bot, str(chat_id), format_activity_message(activity)):
+                    # Leave the cursor and release the claim so this activity is retried on the next run
+                    logger.error(f"Periodic check: Failed to notify user {chat_id} about activity {activity_id}. Stopping.")
+                    await database.release_activity_notification_async(chat_id, activity_id)
+                    return stats
+                stats['messages'] += 1
+                await database.advance_activity_cursor_async(chat_id, get_activity_start_ts(activity), activity_id)
+                activity_count +=1
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            # Whatever was fetched so far is still notified below
+            logger.error(f"Periodic check: Failed to fetch activities for user {chat_id}: {str(e)}")
+            if strava_client.STRAVA_RETRY_POLICY.is_retryable(e):
+                await dead_letter.add_async(dead_letter.ACTIVITY_CHECK, {'chat_id': str(chat_id)}, e)
+
+        if digest:
+            stats['messages'] += await send_digest(bot, chat_id, digest)
+            logger.info(f"Periodic check: Sent a digest of {len(digest)} activities to user {chat_id}.")
+            return stats
+
+        if not activity_count:
+            logger.info(f"Periodic check: No new activities for user {chat_id} since timestamp {after_ts}.")
+            return stats
             
-            message = f"{emoji} <b>{cheer}</b> {duration_minutes} minutes well spent!"
-            send_telegram_message(message, str(chat_id))
-            activity_count +=1
-            
-        send_telegram_message(f"Processed {activity_count} activities. {get_random_signoff()}", str(chat_id))
+        if await send_html_message(bot, str(chat_id), f"Processed {activity_count} activities. {get_random_signoff()}"):
+            stats['messages'] += 1
         logger.info(f"Periodic check: Processed {activity_count} activities for user {chat_id}.")
+        return stats
 
     except Exception as e:
         # Log the full traceback for unexpected errors
         logger.exception(f"Periodic check: Unexpected error processing activities for user {chat_id}: {str(e)}")
+        return stats
+
+def process_activities_for_user(chat_id):
+    """Synchronous wrapper around check_activities_for_user for scripts"""
+    async def run():
+        async with telegram.Bot(token=TELEGRAM_BOT_TOKEN) as bot:
+            try:
+                return await check_activities_for_user(chat_id, bot)
+            finally:
+                await telegram_outbox.close()
+                await strava_client.close()
+                await database.close_async_redis()
+    return asyncio.run(run())
+
+def get_bot():
+    """Get the shared Telegram bot, created on first use and kept for the process lifetime"""
+    global _bot
+    if _bot is None:
+        logger.info(f"Creating shared Telegram bot with connection pool size {TELEGRAM_POOL_SIZE}")
+        _bot = telegram.Bot(
+            token=TELEGRAM_BOT_TOKEN,
+            request=HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE)
+        )
+    return _bot
+
+async def process_update(update, bot=None, resume=False):
+    """Process a single update from webhook
+    
+    Long-running servers pass the shared bot from get_bot(); without one a
+    bot is created for this update only. `resume` marks a redelivery of an
+    update a crashed process may have left half-processed (see
+    UpdateDeduplicator.begin_async).
+    """
+    # Skip updates Telegram redelivered after a slow or failed response
+    update_id = update.get("update_id")
+    if update_id is not None and not await deduplicator.begin_async(update_id, resume=resume):
+        logger.info(f"Skipping duplicate update {update_id}")
+        return
 
-async def process_update(update):
-    """Process a single update from webhook"""
     try:
+
         if "message" in update:
             message = update["message"]
             chat_id = str(message["chat"]["id"])
@@ -588,8 +774,9 @@ async def process_update(update):
             
             logger.info(f"Processing message - chat_id: {chat_id}, text: {text}")
             
-            # Create bot instance for this update
-            bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
+            # Create bot instance for this update unless a shared one was given
+            if bot is None:
+                bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
             
             # Handle commands
             if text.startswith("/"):
@@ -607,25 +794,95 @@ async def process_update(update):
                     await handle_status(bot, update)
             # Handle auth code
             else:
-                session = database.get_auth_session(chat_id)
+                session = await database.get_auth_session_async(chat_id)
                 logger.info(f"Auth session for {chat_id}: {session}")
                 if session:
                     logger.info(f"Processing auth code for chat_id {chat_id}")
                     await handle_auth_code(bot, update)
                 else:
                     logger.info(f"No active auth session found for chat_id {chat_id}")
-                    await bot.send_message(
+                    await telegram_outbox.send_message(
+                        bot,
                         chat_id=chat_id,
                         text="No active authorization session found. Please use /connect to start the authorization process."
                     )
 
     except Exception as e:
         logger.error(f"Error processing update: {str(e)}")
-        if 'bot' in locals() and 'chat_id' in locals():
+        if bot is not None and 'chat_id' in locals():
             try:
-                await bot.send_message(
+                await telegram_outbox.send_message(
+                    bot,
                     chat_id=chat_id,
                     text="Sorry, there was an error processing your message. Please try again."
                 )
             except Exception as send_error:
                 logger.error(f"Error sending error message: {str(send_error)}")
+
+    if update_id is not None:
+        await deduplicator.finish_async(update_id)
+
+async def run_activity_check(bot, concurrency=ACTIVITY_CHECK_CONCURRENCY, batch_size=ACTIVITY_CHECK_BATCH_SIZE):
+    """Check activities for every connected user with bounded concurrency
+    
+    Returns the totals for the run.
+    """
+    start = time.monotonic()
+    totals = {'users': 0, 'activities': 0, 'messages': 0}
+    logger.info(f"Activity check: Starting run with concurrency {concurrency}")
+
+    def collect(task):
+        stats = task.result()
+        totals['users'] += 1
+        totals['activities'] += stats['activities']
+        totals['messages'] += stats['messages']
+
+    in_flight = set()
+
+    async def check_batch(chat_ids):
+        nonlocal in_flight
+        # One round trip for the whole batch instead of one per user
+        users = await database.get_users_async(chat_ids)
+        for chat_id in chat_ids:
+            # Keep at most `concurrency` users in flight instead of scheduling everyone up front
+            if len(in_flight) >= concurrency:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    collect(task)
+            in_flight.add(asyncio.create_task(check_activities_for_user(chat_id, bot, users.get(chat_id))))
+
+    batch = []
+    async for chat_id in database.iter_users_async():
+        batch.append(chat_id)
+        if len(batch) == batch_size:
+            await check_batch(batch)
+            batch = []
+    if batch:
+        await check_batch(batch)
+    if in_flight:
+        done, _ = await asyncio.wait(in_flight)
+        for task in done:
+            collect(task)
+
+    totals['wall_time'] = round(time.monotonic() - start, 2)
+    logger.info(
+        f"Activity check: Checked {totals['users']} users, found {totals['activities']} activities, "
+        f"sent {totals['messages']} messages in {totals['wall_time']}s"
+    )
+    return totals
+
+async def run_scheduled_check(concurrency=ACTIVITY_CHECK_CONCURRENCY):
+    """Run one activity check with the shared bot and clients, closing them afterwards"""
+    async with get_bot() as bot:
+        try:
+            return await run_activity_check(bot, concurrency)
+        finally:
+            await telegram_outbox.close()
+            await strava_client.close()
+            await database.close_async_redis()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check all connected users for new Strava activities')
+    parser.add_argument('--concurrency', type=int, default=ACTIVITY_CHECK_CONCURRENCY, help='Maximum users checked at once')
+    args = parser.parse_args()
+    asyncio.run(run_scheduled_check(args.concurrency))
@@ -1,6 +1,8 @@
-from flask import Flask, request, render_template_string
+from flask import Flask, request
 import os
+import html
 import logging
+from jinja2 import Environment
 from dotenv import load_dotenv
 
 # Set up logging
@@ -113,25 +115,32 @@ SUCCESS_TEMPLATE = """
 </html>
 """
 
-@app.route('/')
-def callback():
-    """Handle the OAuth callback from Strava"""
-    code = request.args.get('code')
-    state = request.args.get('state')
-    error = request.args.get('error')
-    
+# Autoescaping environment, matching Flask's render_template_string behaviour
+_template_env = Environment(autoescape=True)
+
+def render_callback(code, state, error):
+    """Render the OAuth callback page for the given query parameters"""
     logger.info(f"Received callback with code: {code}, state: {state}, error: {error}")
     
     if error:
         logger.error(f"Authorization error: {error}")
-        return f"Authorization error: {error}"
+        return f"Authorization error: {html.escape(error)}"
         
     if code:
         logger.info("Successfully received authorization code")
-        return render_template_string(SUCCESS_TEMPLATE, code=code)
+        return _template_env.from_string(SUCCESS_TEMPLATE).render(code=code)
         
     logger.error("No authorization code received")
     return "No authorization code received."
 
+@app.route('/')
+def callback():
+    """Handle the OAuth callback from Strava"""
+    return render_callback(
+        request.args.get('code'),
+        request.args.get('state'),
+        request.args.get('error')
+    )
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080))) 
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import signal
+import asyncio
+import logging
+import argparse
+import database
+from main import get_bot
+import telegram_outbox
+import strava_client
+from dispatcher import ChatDispatcher, DISPATCH_CONCURRENCY
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler()  # Only use stdout/stderr
+    ]
+)
+logger = logging.getLogger(__name__)
+
+# Redis key holding the next update_id to request
+UPDATE_OFFSET_KEY = 'telegram:updates_offset'
+
+# Long polling settings (Telegram returns at most 100 updates per call)
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '30'))
+POLL_BATCH_SIZE = min(int(os.getenv('POLL_BATCH_SIZE', '100')), 100)
+POLL_ERROR_DELAY = 5
+
+def load_offset():
+    """Load the persisted getUpdates offset from Redis"""
+    # Without it Telegram resends the updates it hasn't seen confirmed
+    if not database.uses_redis():
+        return None
+    try:
+        offset = database.get_redis().get(UPDATE_OFFSET_KEY)
+        return int(offset) if offset is not None else None
+    except Exception as e:
+        logger.error(f"Error loading update offset: {str(e)}")
+        return None
+
+def save_offset(offset):
+    """Persist the getUpdates offset to Redis"""
+    if not database.uses_redis():
+        return False
+    try:
+        database.get_redis().set(UPDATE_OFFSET_KEY, offset)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving update offset {offset}: {str(e)}")
+        return False
+
+async def process_batch(dispatcher, updates):
+    """Dispatch a batch of updates, concurrently across chats and in order within each chat"""
+    # getUpdates never repeats an update past the saved offset, so anything seen
+    # again was fetched before a crash and may be half-processed
+    results = await dispatcher.dispatch_batch([update.to_dict() for update in updates], resume=True)
+    for update, result in zip(updates, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error processing update {update.update_id}: {str(result)}")
+
+async def run_polling(delete_webhook=False, concurrency=DISPATCH_CONCURRENCY):
+    """Fetch updates with getUpdates long polling until interrupted"""
+    bot = get_bot()
+    await bot.initialize()
+    dispatcher = ChatDispatcher(bot, concurrency)
+
+    if delete_webhook:
+        # getUpdates is refused while a webhook is configured
+        await bot.delete_webhook()
+        logger.info("Deleted the configured webhook")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    offset = load_offset()
+    logger.info(f"Starting long polling from offset {offset}")
+    try:
+        while not stop.is_set():
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    limit=POLL_BATCH_SIZE,
+                    timeout=POLL_TIMEOUT
+                )
+            except Exception as e:
+                logger.error(f"Error fetching updates: {str(e)}")
+                await asyncio.sleep(POLL_ERROR_DELAY)
+                continue
+
+            if not updates:
+                continue
+
+            logger.info(f"Fetched {len(updates)} updates")
+            await process_batch(dispatcher, updates)
+
+            # Only move past the batch once it has been processed
+            offset = updates[-1].update_id + 1
+            save_offset(offset)
+    finally:
+        await telegram_outbox.close()
+        await strava_client.close()
+        await database.close_async_redis()
+        await bot.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the bot with getUpdates long polling')
+    parser.add_argument('--delete-webhook', action='store_true', help='Remove the configured webhook before polling')
+    parser.add_argument('--concurrency', type=int, default=DISPATCH_CONCURRENCY, help='Maximum chats processed at once')
+    args = parser.parse_args()
+    asyncio.run(run_polling(delete_webhook=args.delete_webhook, concurrency=args.concurrency))
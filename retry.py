@@ -0,0 +1,112 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import httpx
+import telegram
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '30'))
+
+# Statuses worth another attempt: server-side failures and rate limiting
+SERVER_ERROR_STATUSES = frozenset({500, 502, 503, 504})
+RETRY_STATUSES = SERVER_ERROR_STATUSES | {429}
+
+# Transport errors raised before any of the request reached the server
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class RetryPolicy:
+    """Retry transient failures with exponential backoff and full jitter
+
+    Only errors that another attempt can fix are retried: transport errors,
+    retryable HTTP statuses and Telegram network errors. Anything else, and the
+    last failure once `max_attempts` is reached, is raised to the caller.
+
+    Requests that must not run twice (sending a message, redeeming a
+    single-use code or refresh token) use `idempotent=False`: they are only
+    retried when the request never left, since after a read timeout or an
+    error response the server may already have acted on it.
+
+    Callers whose requests already wait out Telegram's RetryAfter themselves
+    (the outbox does) use `retry_after=False`, so retries don't multiply.
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 retry_statuses=RETRY_STATUSES, idempotent=True, retry_after=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.idempotent = idempotent
+        self.retry_after = retry_after
+
+    def delay(self, attempt):
+        """Seconds to wait after the given (zero-based) failed attempt"""
+        # Full jitter keeps callers that failed together from retrying together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def max_duration(self, attempt_seconds):
+        """Longest `run` can take when every attempt takes `attempt_seconds` and fails"""
+        backoff = sum(min(self.max_delay, self.base_delay * 2 ** attempt) for attempt in range(self.max_attempts - 1))
+        return self.max_attempts * attempt_seconds + backoff
+
+    def is_retryable(self, error):
+        """Check whether an error is transient"""
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in self.retry_statuses
+        if isinstance(error, httpx.TransportError):
+            return True
+        # BadRequest is a NetworkError in python-telegram-bot, but retrying won't fix it
+        if isinstance(error, telegram.error.BadRequest):
+            return False
+        return isinstance(error, (telegram.error.NetworkError, telegram.error.RetryAfter))
+
+    @staticmethod
+    def was_not_sent(error):
+        """Check whether a request failed before the server could act on it"""
+        # Telegram turned the request down without handling it
+        if isinstance(error, telegram.error.RetryAfter):
+            return True
+        # python-telegram-bot wraps the httpx error it got
+        if isinstance(error, telegram.error.NetworkError):
+            error = error.__cause__
+        return isinstance(error, UNSENT_ERRORS)
+
+    def may_retry(self, error):
+        """Check whether another attempt is both useful and safe"""
+        if isinstance(error, telegram.error.RetryAfter) and not self.retry_after:
+            return False
+        return self.is_retryable(error) and (self.idempotent or self.was_not_sent(error))
+
+    async def run(self, func, *args, **kwargs):
+        """Await `func(*args, **kwargs)`, retrying transient failures"""
+        for attempt in range(self.max_attempts):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_attempts - 1 or not self.may_retry(e):
+                    raise
+                delay = self.delay(attempt)
+                logger.warning(f"Attempt {attempt + 1} of {func.__name__} failed: {str(e)}, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def call(self, func, *args, **kwargs):
+        """Call `func(*args, **kwargs)`, retrying transient failures"""
+        for attempt in range(self.max_attempts):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_attempts - 1 or not self.may_retry(e):
+                    raise
+                delay = self.delay(attempt)
+                logger.warning(f"Attempt {attempt + 1} of {func.__name__} failed: {str(e)}, retrying in {delay:.2f}s")
+                time.sleep(delay)
@@ -0,0 +1,557 @@
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+import itertools
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# SQLite database for STORAGE_BACKEND=sqlite; its legacy `users` table is left alone
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'strava_bot.db')
+# How long a write waits for another process's write lock before failing
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+class StorageBackend:
+    """Where user records, auth sessions and the notified-activity ledger live
+
+    Methods raise on failure; database.py logs errors and turns them into the
+    return values its callers expect. The async variants run the sync ones in a
+    worker thread unless a backend has native async I/O.
+    """
+
+    def add_user(self, chat_id, access_token, refresh_token, expires_at, athlete_id=None):
+        """Store a user's tokens, keeping its activity cursor and known athlete"""
+        raise NotImplementedError
+
+    def get_user(self, chat_id):
+        """Get a user record, or None if the user doesn't exist"""
+        raise NotImplementedError
+
+    def get_users(self, chat_ids):
+        """Get a dict mapping each chat ID to its user record or None"""
+        raise NotImplementedError
+
+    def remove_user(self, chat_id):
+        raise NotImplementedError
+
+    def iter_users(self, batch_size):
+        """Yield the chat IDs of all users, loading `batch_size` at a time"""
+        raise NotImplementedError
+
+    def get_users_expiring_before(self, before, limit=None):
+        """Get chat IDs whose token expires before the given datetime, soonest first"""
+        raise NotImplementedError
+
+    def set_user_athlete(self, chat_id, athlete_id):
+        raise NotImplementedError
+
+    def get_chat_id_for_athlete(self, athlete_id):
+        raise NotImplementedError
+
+    def advance_activity_cursor(self, chat_id, activity_ts, activity_id):
+        """Move the cursor forward unless the user is gone or it is already past the activity"""
+        raise NotImplementedError
+
+    def claim_activity_notification(self, chat_id, activity_id, retention, max_entries):
+        """Record an activity as notified, returning False if it already was"""
+        raise NotImplementedError
+
+    def release_activity_notification(self, chat_id, activity_id):
+        raise NotImplementedError
+
+    def add_auth_session(self, chat_id, state, timestamp, ttl):
+        raise NotImplementedError
+
+    def get_auth_session(self, chat_id):
+        """Get an unexpired auth session, or None"""
+        raise NotImplementedError
+
+    def remove_auth_session(self, chat_id):
+        raise NotImplementedError
+
+    def cleanup_expired_sessions(self):
+        """Delete expired auth sessions, returning how many were deleted"""
+        return 0
+
+    def acquire_lock(self, name, token, ttl_ms):
+        """Take a lock shared by all processes, returning False if someone else holds it"""
+        raise NotImplementedError
+
+    def is_locked(self, name):
+        raise NotImplementedError
+
+    def release_lock(self, name, token):
+        """Release a lock, unless it expired and was taken by someone else meanwhile"""
+        raise NotImplementedError
+
+    async def add_user_async(self, *args, **kwargs):
+        return await asyncio.to_thread(self.add_user, *args, **kwargs)
+
+    async def get_user_async(self, chat_id):
+        return await asyncio.to_thread(self.get_user, chat_id)
+
+    async def get_users_async(self, chat_ids):
+        return await asyncio.to_thread(self.get_users, chat_ids)
+
+    async def remove_user_async(self, chat_id):
+        return await asyncio.to_thread(self.remove_user, chat_id)
+
+    async def iter_users_async(self, batch_size):
+        # Fetch each page in a worker thread
+        chat_ids = self.iter_users(batch_size)
+        while True:
+            page = await asyncio.to_thread(lambda: list(itertools.islice(chat_ids, batch_size)))
+            for chat_id in page:
+                yield chat_id
+            if len(page) < batch_size:
+                return
+
+    async def get_chat_id_for_athlete_async(self, athlete_id):
+        return await asyncio.to_thread(self.get_chat_id_for_athlete, athlete_id)
+
+    async def get_users_expiring_before_async(self, before, limit=None):
+        return await asyncio.to_thread(self.get_users_expiring_before, before, limit)
+
+    async def set_user_athlete_async(self, chat_id, athlete_id):
+        return await asyncio.to_thread(self.set_user_athlete, chat_id, athlete_id)
+
+    async def advance_activity_cursor_async(self, chat_id, activity_ts, activity_id):
+        return await asyncio.to_thread(self.advance_activity_cursor, chat_id, activity_ts, activity_id)
+
+    async def claim_activity_notification_async(self, chat_id, activity_id, retention, max_entries):
+        return await asyncio.to_thread(self.claim_activity_notification, chat_id, activity_id, retention, max_entries)
+
+    async def release_activity_notification_async(self, chat_id, activity_id):
+        return await asyncio.to_thread(self.release_activity_notification, chat_id, activity_id)
+
+    async def add_auth_session_async(self, *args, **kwargs):
+        return await asyncio.to_thread(self.add_auth_session, *args, **kwargs)
+
+    async def get_auth_session_async(self, chat_id):
+        return await asyncio.to_thread(self.get_auth_session, chat_id)
+
+    async def remove_auth_session_async(self, chat_id):
+        return await asyncio.to_thread(self.remove_auth_session, chat_id)
+
+    async def acquire_lock_async(self, name, token, ttl_ms):
+        return await asyncio.to_thread(self.acquire_lock, name, token, ttl_ms)
+
+    async def is_locked_async(self, name):
+        return await asyncio.to_thread(self.is_locked, name)
+
+    async def release_lock_async(self, name, token):
+        return await asyncio.to_thread(self.release_lock, name, token)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_records (
+    chat_id TEXT PRIMARY KEY,
+    access_token TEXT NOT NULL,
+    refresh_token TEXT NOT NULL,
+    expires_at TEXT NOT NULL,
+    expires_ts REAL NOT NULL,
+    athlete_id TEXT,
+    last_activity_ts INTEGER,
+    last_activity_id TEXT
+);
+CREATE INDEX IF NOT EXISTS user_records_expires_ts ON user_records (expires_ts);
+CREATE INDEX IF NOT EXISTS user_records_athlete_id ON user_records (athlete_id);
+CREATE TABLE IF NOT EXISTS auth_sessions (
+    chat_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    expires_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS auth_sessions_expires_ts ON auth_sessions (expires_ts);
+CREATE TABLE IF NOT EXISTS notified_activities (
+    chat_id TEXT NOT NULL,
+    activity_id TEXT NOT NULL,
+    notified_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, activity_id)
+);
+CREATE TABLE IF NOT EXISTS locks (
+    name TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    expires_ts REAL NOT NULL
+);
+"""
+
+# Statements are kept constant so each connection's statement cache reuses them
+SQL_UPSERT_USER = """
+INSERT INTO user_records (chat_id, access_token, refresh_token, expires_at, expires_ts, athlete_id)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET
+    access_token = excluded.access_token,
+    refresh_token = excluded.refresh_token,
+    expires_at = excluded.expires_at,
+    expires_ts = excluded.expires_ts,
+    athlete_id = COALESCE(excluded.athlete_id, user_records.athlete_id)
+"""
+SQL_USER_COLUMNS = "chat_id, access_token, refresh_token, expires_at, last_activity_ts, last_activity_id, athlete_id"
+SQL_GET_USER = f"SELECT {SQL_USER_COLUMNS} FROM user_records WHERE chat_id = ?"
+SQL_DELETE_USER = "DELETE FROM user_records WHERE chat_id = ?"
+SQL_DELETE_USER_NOTIFIED = "DELETE FROM notified_activities WHERE chat_id = ?"
+SQL_USERS_PAGE = "SELECT chat_id FROM user_records WHERE chat_id > ? ORDER BY chat_id LIMIT ?"
+SQL_EXPIRING_BEFORE = "SELECT chat_id FROM user_records WHERE expires_ts < ? ORDER BY expires_ts LIMIT ?"
+SQL_SET_ATHLETE = "UPDATE user_records SET athlete_id = ? WHERE chat_id = ?"
+SQL_GET_ATHLETE_CHAT_ID = "SELECT chat_id FROM user_records WHERE athlete_id = ? LIMIT 1"
+SQL_ADVANCE_CURSOR = """
+UPDATE user_records SET last_activity_ts = ?, last_activity_id = ?
+WHERE chat_id = ? AND (last_activity_ts IS NULL OR last_activity_ts <= ?)
+"""
+SQL_CLAIM_NOTIFIED = "INSERT OR IGNORE INTO notified_activities (chat_id, activity_id, notified_at) VALUES (?, ?, ?)"
+SQL_TRIM_NOTIFIED = """
+DELETE FROM notified_activities WHERE chat_id = ? AND (notified_at < ? OR activity_id NOT IN (
+    SELECT activity_id FROM notified_activities WHERE chat_id = ? ORDER BY notified_at DESC LIMIT ?
+))
+"""
+SQL_RELEASE_NOTIFIED = "DELETE FROM notified_activities WHERE chat_id = ? AND activity_id = ?"
+SQL_UPSERT_SESSION = """
+INSERT INTO auth_sessions (chat_id, state, timestamp, expires_ts) VALUES (?, ?, ?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET
+    state = excluded.state, timestamp = excluded.timestamp, expires_ts = excluded.expires_ts
+"""
+SQL_GET_SESSION = "SELECT state, timestamp FROM auth_sessions WHERE chat_id = ? AND expires_ts > ?"
+SQL_DELETE_SESSION = "DELETE FROM auth_sessions WHERE chat_id = ?"
+SQL_SWEEP_SESSIONS = "DELETE FROM auth_sessions WHERE expires_ts <= ?"
+# Takes the lock if it is free or its holder's lease ran out
+SQL_ACQUIRE_LOCK = """
+INSERT INTO locks (name, token, expires_ts) VALUES (?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET token = excluded.token, expires_ts = excluded.expires_ts
+WHERE locks.expires_ts <= ?
+"""
+SQL_IS_LOCKED = "SELECT 1 FROM locks WHERE name = ? AND expires_ts > ?"
+SQL_RELEASE_LOCK = "DELETE FROM locks WHERE name = ? AND token = ?"
+# Users looked up per IN (...) query, well under SQLite's bound parameter limit
+SQLITE_LOOKUP_BATCH_SIZE = 500
+
+def _user_from_row(row):
+    chat_id, access_token, refresh_token, expires_at, last_activity_ts, last_activity_id, athlete_id = row
+    return {
+        'chat_id': chat_id,
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_at': datetime.fromisoformat(expires_at),
+        'last_activity_ts': last_activity_ts,
+        'last_activity_id': last_activity_id,
+        'athlete_id': athlete_id
+    }
+
+class SQLiteBackend(StorageBackend):
+    """Storage in a local SQLite file, for deployments without Redis
+
+    Each thread gets its own connection in WAL mode, so readers never wait for
+    the writer; all processes using the file must run on the same host.
+    Expired auth sessions are hidden on read and swept whenever one is added.
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+        logger.info(f"Using SQLite storage at {path}")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, cached_statements=128)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Durable across process crashes; only an OS crash can lose the last commits
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add_user(self, chat_id, access_token, refresh_token, expires_at, athlete_id=None):
+        with self._connection() as conn:
+            conn.execute(SQL_UPSERT_USER, (
+                str(chat_id), access_token, refresh_token, expires_at.isoformat(), expires_at.timestamp(),
+                str(athlete_id) if athlete_id else None
+            ))
+
+    def get_user(self, chat_id):
+        row = self._connection().execute(SQL_GET_USER, (str(chat_id),)).fetchone()
+        if row is None:
+            return None
+        user = _user_from_row(row)
+        user['chat_id'] = chat_id
+        return user
+
+    def get_users(self, chat_ids):
+        conn = self._connection()
+        found = {}
+        for start in range(0, len(chat_ids), SQLITE_LOOKUP_BATCH_SIZE):
+            batch = [str(chat_id) for chat_id in chat_ids[start:start + SQLITE_LOOKUP_BATCH_SIZE]]
+            placeholders = ', '.join('?' * len(batch))
+            rows = conn.execute(f"SELECT {SQL_USER_COLUMNS} FROM user_records WHERE chat_id IN ({placeholders})", batch)
+            for row in rows:
+                found[row[0]] = _user_from_row(row)
+        users = {}
+        for chat_id in chat_ids:
+            user = found.get(str(chat_id))
+            if user:
+                user = dict(user, chat_id=chat_id)
+            users[chat_id] = user
+        return users
+
+    def remove_user(self, chat_id):
+        with self._connection() as conn:
+            conn.execute(SQL_DELETE_USER, (str(chat_id),))
+            conn.execute(SQL_DELETE_USER_NOTIFIED, (str(chat_id),))
+
+    def iter_users(self, batch_size):
+        # Keyset pagination, so each page is an index range scan
+        last = ''
+        while True:
+            chat_ids = [row[0] for row in self._connection().execute(SQL_USERS_PAGE, (last, batch_size))]
+            yield from chat_ids
+            if len(chat_ids) < batch_size:
+                return
+            last = chat_ids[-1]
+
+    def get_users_expiring_before(self, before, limit=None):
+        # LIMIT -1 means no limit in SQLite
+        rows = self._connection().execute(SQL_EXPIRING_BEFORE, (before.timestamp(), -1 if limit is None else limit))
+        return [row[0] for row in rows]
+
+    def set_user_athlete(self, chat_id, athlete_id):
+        with self._connection() as conn:
+            conn.execute(SQL_SET_ATHLETE, (str(athlete_id), str(chat_id)))
+
+    def get_chat_id_for_athlete(self, athlete_id):
+        row = self._connection().execute(SQL_GET_ATHLETE_CHAT_ID, (str(athlete_id),)).fetchone()
+        return row[0] if row else None
+
+    def advance_activity_cursor(self, chat_id, activity_ts, activity_id):
+        with self._connection() as conn:
+            cursor = conn.execute(SQL_ADVANCE_CURSOR, (int(activity_ts), str(activity_id), str(chat_id), int(activity_ts)))
+            return cursor.rowcount > 0
+
+    def claim_activity_notification(self, chat_id, activity_id, retention, max_entries):
+        now = time.time()
+        with self._connection() as conn:
+            added = conn.execute(SQL_CLAIM_NOTIFIED, (str(chat_id), str(activity_id), now)).rowcount > 0
+            conn.execute(SQL_TRIM_NOTIFIED, (str(chat_id), now - retention, str(chat_id), max_entries))
+        return added
+
+    def release_activity_notification(self, chat_id, activity_id):
+        with self._connection() as conn:
+            conn.execute(SQL_RELEASE_NOTIFIED, (str(chat_id), str(activity_id)))
+
+    def add_auth_session(self, chat_id, state, timestamp, ttl):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(SQL_SWEEP_SESSIONS, (now,))
+            conn.execute(SQL_UPSERT_SESSION, (str(chat_id), state, timestamp.isoformat(), now + ttl))
+
+    def get_auth_session(self, chat_id):
+        row = self._connection().execute(SQL_GET_SESSION, (str(chat_id), time.time())).fetchone()
+        if row is None:
+            return None
+        return {'state': row[0], 'timestamp': datetime.fromisoformat(row[1])}
+
+    def remove_auth_session(self, chat_id):
+        with self._connection() as conn:
+            conn.execute(SQL_DELETE_SESSION, (str(chat_id),))
+
+    def cleanup_expired_sessions(self):
+        with self._connection() as conn:
+            return conn.execute(SQL_SWEEP_SESSIONS, (time.time(),)).rowcount
+
+    def acquire_lock(self, name, token, ttl_ms):
+        now = time.time()
+        with self._connection() as conn:
+            return conn.execute(SQL_ACQUIRE_LOCK, (name, token, now + ttl_ms / 1000, now)).rowcount > 0
+
+    def is_locked(self, name):
+        return self._connection().execute(SQL_IS_LOCKED, (name, time.time())).fetchone() is not None
+
+    def release_lock(self, name, token):
+        with self._connection() as conn:
+            conn.execute(SQL_RELEASE_LOCK, (name, token))
+
+class MemoryBackend(StorageBackend):
+    """Storage in this process's memory, for tests and benchmarks
+
+    Nothing is persisted or shared with other processes.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._sessions = {}
+        self._notified = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def add_user(self, chat_id, access_token, refresh_token, expires_at, athlete_id=None):
+        with self._lock:
+            user = self._users.setdefault(str(chat_id), {'last_activity_ts': None, 'last_activity_id': None, 'athlete_id': None})
+            user.update(access_token=access_token, refresh_token=refresh_token, expires_at=expires_at)
+            if athlete_id:
+                user['athlete_id'] = str(athlete_id)
+
+    def get_user(self, chat_id):
+        with self._lock:
+            user = self._users.get(str(chat_id))
+            return dict(user, chat_id=chat_id) if user else None
+
+    def get_users(self, chat_ids):
+        return {chat_id: self.get_user(chat_id) for chat_id in chat_ids}
+
+    def remove_user(self, chat_id):
+        with self._lock:
+            self._users.pop(str(chat_id), None)
+            self._notified.pop(str(chat_id), None)
+
+    def iter_users(self, batch_size):
+        with self._lock:
+            chat_ids = list(self._users)
+        yield from chat_ids
+
+    def get_users_expiring_before(self, before, limit=None):
+        with self._lock:
+            expiring = sorted(
+                (user['expires_at'].timestamp(), chat_id) for chat_id, user in self._users.items()
+                if user['expires_at'].timestamp() < before.timestamp()
+            )
+        return [chat_id for _, chat_id in expiring[:limit]]
+
+    def set_user_athlete(self, chat_id, athlete_id):
+        with self._lock:
+            user = self._users.get(str(chat_id))
+            if user:
+                user['athlete_id'] = str(athlete_id)
+
+    def get_chat_id_for_athlete(self, athlete_id):
+        with self._lock:
+            for chat_id, user in self._users.items():
+                if user['athlete_id'] == str(athlete_id):
+                    return chat_id
+        return None
+
+    def advance_activity_cursor(self, chat_id, activity_ts, activity_id):
+        with self._lock:
+            user = self._users.get(str(chat_id))
+            if user is None or (user['last_activity_ts'] is not None and int(activity_ts) < user['last_activity_ts']):
+                return False
+            user['last_activity_ts'] = int(activity_ts)
+            user['last_activity_id'] = str(activity_id)
+            return True
+
+    def claim_activity_notification(self, chat_id, activity_id, retention, max_entries):
+        now = time.time()
+        with self._lock:
+            notified = self._notified.setdefault(str(chat_id), OrderedDict())
+            if str(activity_id) in notified:
+                return False
+            notified[str(activity_id)] = now
+            while notified and (len(notified) > max_entries or next(iter(notified.values())) < now - retention):
+                notified.popitem(last=False)
+            return True
+
+    def release_activity_notification(self, chat_id, activity_id):
+        with self._lock:
+            self._notified.get(str(chat_id), {}).pop(str(activity_id), None)
+
+    def add_auth_session(self, chat_id, state, timestamp, ttl):
+        with self._lock:
+            self._sessions[str(chat_id)] = ({'state': state, 'timestamp': timestamp}, time.time() + ttl)
+
+    def get_auth_session(self, chat_id):
+        with self._lock:
+            entry = self._sessions.get(str(chat_id))
+            if entry is None or entry[1] <= time.time():
+                return None
+            return dict(entry[0])
+
+    def remove_auth_session(self, chat_id):
+        with self._lock:
+            self._sessions.pop(str(chat_id), None)
+
+    def cleanup_expired_sessions(self):
+        now = time.time()
+        with self._lock:
+            expired = [chat_id for chat_id, (_, expires_ts) in self._sessions.items() if expires_ts <= now]
+            for chat_id in expired:
+                del self._sessions[chat_id]
+        return len(expired)
+
+    def acquire_lock(self, name, token, ttl_ms):
+        now = time.time()
+        with self._lock:
+            holder = self._locks.get(name)
+            if holder is not None and holder[1] > now:
+                return False
+            self._locks[name] = (token, now + ttl_ms / 1000)
+            return True
+
+    def is_locked(self, name):
+        with self._lock:
+            holder = self._locks.get(name)
+            return holder is not None and holder[1] > time.time()
+
+    def release_lock(self, name, token):
+        with self._lock:
+            if self._locks.get(name, (None,))[0] == token:
+                del self._locks[name]
+
+    # No I/O to wait for, so there's no point handing these to a thread
+    async def add_user_async(self, *args, **kwargs):
+        return self.add_user(*args, **kwargs)
+
+    async def get_user_async(self, chat_id):
+        return self.get_user(chat_id)
+
+    async def get_users_async(self, chat_ids):
+        return self.get_users(chat_ids)
+
+    async def remove_user_async(self, chat_id):
+        return self.remove_user(chat_id)
+
+    async def iter_users_async(self, batch_size):
+        for chat_id in self.iter_users(batch_size):
+            yield chat_id
+
+    async def get_chat_id_for_athlete_async(self, athlete_id):
+        return self.get_chat_id_for_athlete(athlete_id)
+
+    async def get_users_expiring_before_async(self, before, limit=None):
+        return self.get_users_expiring_before(before, limit)
+
+    async def set_user_athlete_async(self, chat_id, athlete_id):
+        return self.set_user_athlete(chat_id, athlete_id)
+
+    async def advance_activity_cursor_async(self, chat_id, activity_ts, activity_id):
+        return self.advance_activity_cursor(chat_id, activity_ts, activity_id)
+
+    async def claim_activity_notification_async(self, chat_id, activity_id, retention, max_entries):
+        return self.claim_activity_notification(chat_id, activity_id, retention, max_entries)
+
+    async def release_activity_notification_async(self, chat_id, activity_id):
+        return self.release_activity_notification(chat_id, activity_id)
+
+    async def add_auth_session_async(self, *args, **kwargs):
+        return self.add_auth_session(*args, **kwargs)
+
+    async def get_auth_session_async(self, chat_id):
+        return self.get_auth_session(chat_id)
+
+    async def remove_auth_session_async(self, chat_id):
+        return self.remove_auth_session(chat_id)
+
+    async def acquire_lock_async(self, name, token, ttl_ms):
+        return self.acquire_lock(name, token, ttl_ms)
+
+    async def is_locked_async(self, name):
+        return self.is_locked(name)
+
+    async def release_lock_async(self, name, token):
+        return self.release_lock(name, token)
@@ -1,9 +1,13 @@
 import os
-import requests
+import httpx
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
 from urllib.parse import quote_plus
+import strava_ratelimit
+import http_clients
+import retry
+from circuit_breaker import CircuitOpenError, get_breaker
 
 # Set up logging
 logging.basicConfig(
@@ -19,6 +23,9 @@ load_dotenv()
 STRAVA_CLIENT_ID = os.getenv('STRAVA_CLIENT_ID')
 STRAVA_CLIENT_SECRET = os.getenv('STRAVA_CLIENT_SECRET')
 STRAVA_REDIRECT_URI = os.getenv('STRAVA_REDIRECT_URI')
+# Base URL of the Strava API, overridable to point at a local fake Strava
+STRAVA_API_URL = os.getenv('STRAVA_API_URL', 'https://www.strava.com/api/v3')
+STRAVA_TOKEN_URL = os.getenv('STRAVA_TOKEN_URL', 'https://www.strava.com/oauth/token')
 
 # Log the loaded environment variables (excluding secret)
 logger.info(f"Loaded environment variables - Client ID: {STRAVA_CLIENT_ID}, Redirect URI: {STRAVA_REDIRECT_URI}")
@@ -48,6 +55,40 @@ def get_strava_header(access_token):
     """Get the header for Strava API requests"""
     return {"Authorization": f"Bearer {access_token}"}
 
+def parse_token_exchange(data):
+    """Build the stored token record from a token exchange response"""
+    # Calculate token expiration
+    expires_in = data.get('expires_in', 21600) # Default to 6 hours
+    expires_at_timestamp = datetime.now().timestamp() + expires_in
+    expires_at_datetime = datetime.fromtimestamp(expires_at_timestamp)
+    
+    logger.info(f"Token expires at: {expires_at_datetime}")
+    
+    return {
+        'access_token': data.get('access_token'),
+        'refresh_token': data.get('refresh_token'),
+        'expires_at': expires_at_datetime, # Return datetime object
+        'athlete_id': data.get('athlete', {}).get('id')
+    }
+
+# 429s are left to the rate limiter rather than retried straight away; the
+# code and refresh token are single-use, so only unsent requests are retried
+TOKEN_RETRY_POLICY = retry.RetryPolicy(retry_statuses=retry.SERVER_ERROR_STATUSES, idempotent=False)
+
+STRAVA_BREAKER = get_breaker(http_clients.STRAVA)
+
+def _post_token_request(data):
+    STRAVA_BREAKER.check()
+    try:
+        response = http_clients.get_client(http_clients.STRAVA).post(STRAVA_TOKEN_URL, data=data)
+    except httpx.TransportError:
+        STRAVA_BREAKER.record(False)
+        raise
+    STRAVA_BREAKER.record(response.status_code < 500)
+    strava_ratelimit.record_response(response)
+    response.raise_for_status()
+    return response
+
 def exchange_code_for_token(code):
     """Exchange the authorization code for access and refresh tokens"""
     try:
@@ -55,30 +96,21 @@ def exchange_code_for_token(code):
             logger.error("Missing required environment variables for token exchange")
             return None
 
-        response = requests.post(
-            "https://www.strava.com/oauth/token",
-            data={
+        # A user is waiting on this exchange, so it may use the interactive reserve
+        if not strava_ratelimit.acquire(strava_ratelimit.INTERACTIVE):
+            logger.error("Skipping token exchange, Strava rate limit budget exhausted")
+            return None
+
+        response = TOKEN_RETRY_POLICY.call(
+            _post_token_request,
+            {
                 "client_id": STRAVA_CLIENT_ID,
                 "client_secret": STRAVA_CLIENT_SECRET,
                 "code": code,
                 "grant_type": "authorization_code"
             }
         )
-        response.raise_for_status()
-        data = response.json()
-        
-        # Calculate token expiration
-        expires_in = data.get('expires_in', 21600) # Default to 6 hours
-        expires_at_timestamp = datetime.now().timestamp() + expires_in
-        expires_at_datetime = datetime.fromtimestamp(expires_at_timestamp)
-        
-        logger.info(f"Token expires at: {expires_at_datetime}")
-        
-        return {
-            'access_token': data.get('access_token'),
-            'refresh_token': data.get('refresh_token'),
-            'expires_at': expires_at_datetime # Return datetime object
-        }
+        return parse_token_exchange(response.json())
     except Exception as e:
         logger.error(f"Error exchanging code for token: {str(e)}")
         return None
@@ -89,19 +121,22 @@ def refresh_access_token(refresh_token):
         logger.error("Missing required parameters for token refresh")
         return None
         
+    if not strava_ratelimit.acquire(strava_ratelimit.BACKGROUND):
+        logger.error("Skipping token refresh, Strava rate limit budget exhausted")
+        return None
+
     try:
-        response = requests.post(
-            'https://www.strava.com/oauth/token',
-            data={
+        response = TOKEN_RETRY_POLICY.call(
+            _post_token_request,
+            {
                 'client_id': STRAVA_CLIENT_ID,
                 'client_secret': STRAVA_CLIENT_SECRET,
                 'refresh_token': refresh_token,
                 'grant_type': 'refresh_token'
             }
         )
-        response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, CircuitOpenError) as e:
         logger.error(f"Error refreshing token: {str(e)}")
         return None
 
@@ -110,7 +145,7 @@ if __name__ == "__main__":
     headers = get_strava_header()
     if headers:
         try:
-            response = requests.get(
+            response = http_clients.get_client(http_clients.STRAVA).get(
                 "https://www.strava.com/api/v3/athlete/activities",
                 headers=headers
             )
@@ -118,7 +153,7 @@ if __name__ == "__main__":
             print("✅ Successfully connected to Strava API")
             activities = response.json()
             print(f"Found {len(activities)} activities")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"❌ Error accessing Strava API: {str(e)}")
     else:
         print("❌ Could not get authorization header")
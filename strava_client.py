@@ -0,0 +1,204 @@
+import os
+import asyncio
+import logging
+import weakref
+import httpx
+import strava_ratelimit
+import http_clients
+import retry
+from circuit_breaker import CircuitOpenError, get_breaker
+from strava_auth import (
+    STRAVA_CLIENT_ID, STRAVA_CLIENT_SECRET, STRAVA_API_URL, STRAVA_TOKEN_URL, parse_token_exchange
+)
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Retries for transport errors and 5xx responses
+STRAVA_MAX_RETRIES = int(os.getenv('STRAVA_MAX_RETRIES', '3'))
+STRAVA_RETRY_BACKOFF = float(os.getenv('STRAVA_RETRY_BACKOFF', '0.5'))
+# 429s are left to the rate limiter, which already waits for the next window
+STRAVA_RETRY_POLICY = retry.RetryPolicy(
+    max_attempts=STRAVA_MAX_RETRIES + 1,
+    base_delay=STRAVA_RETRY_BACKOFF,
+    retry_statuses=retry.SERVER_ERROR_STATUSES
+)
+# Token requests redeem a single-use code or a rotating refresh token
+STRAVA_TOKEN_RETRY_POLICY = retry.RetryPolicy(
+    max_attempts=STRAVA_MAX_RETRIES + 1,
+    base_delay=STRAVA_RETRY_BACKOFF,
+    retry_statuses=retry.SERVER_ERROR_STATUSES,
+    idempotent=False
+)
+# Activities requested per page (200 is the maximum)
+STRAVA_PAGE_SIZE = int(os.getenv('STRAVA_PAGE_SIZE', '200'))
+
+STRAVA_BREAKER = get_breaker(http_clients.STRAVA)
+
+# One client per event loop, since pooled connections can't move between loops
+_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    """Get the shared async HTTP client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=http_clients.HTTP_POOL_SIZE,
+                max_keepalive_connections=http_clients.HTTP_POOL_SIZE,
+                keepalive_expiry=http_clients.HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(http_clients.HTTP_TIMEOUT, connect=http_clients.HTTP_CONNECT_TIMEOUT),
+            http2=http_clients.use_http2()
+        )
+        _clients[loop] = client
+    return client
+
+async def close():
+    """Close the client of the running event loop"""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+async def _request(method, url, priority=strava_ratelimit.BACKGROUND, retry_policy=STRAVA_RETRY_POLICY, **kwargs):
+    """Send a Strava request within the rate limit budget, retrying transient failures
+
+    Returns the response, or None if the budget is exhausted. Raises
+    CircuitOpenError without calling Strava while it keeps failing.
+    """
+    async def send_once():
+        STRAVA_BREAKER.check()
+        # Background requests may wait for the next rate limit window
+        if not await strava_ratelimit.acquire_async(priority):
+            logger.error(f"Skipping Strava request to {url}, rate limit budget exhausted")
+            return None
+        try:
+            response = await get_async_client().request(method, url, **kwargs)
+        except httpx.TransportError:
+            STRAVA_BREAKER.record(False)
+            raise
+        STRAVA_BREAKER.record(response.status_code < 500)
+        await strava_ratelimit.record_response_async(response)
+        response.raise_for_status()
+        return response
+
+    return await retry_policy.run(send_once)
+
+async def exchange_code_for_token(code):
+    """Exchange the authorization code for access and refresh tokens"""
+    if not STRAVA_CLIENT_ID or not STRAVA_CLIENT_SECRET:
+        logger.error("Missing required environment variables for token exchange")
+        return None
+    try:
+        # A user is waiting on this exchange, so it may use the interactive reserve
+        response = await _request(
+            'POST',
+            STRAVA_TOKEN_URL,
+            priority=strava_ratelimit.INTERACTIVE,
+            retry_policy=STRAVA_TOKEN_RETRY_POLICY,
+            data={
+                'client_id': STRAVA_CLIENT_ID,
+                'client_secret': STRAVA_CLIENT_SECRET,
+                'code': code,
+                'grant_type': 'authorization_code'
+            }
+        )
+        return parse_token_exchange(response.json()) if response else None
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error(f"Error exchanging code for token: {str(e)}")
+        return None
+
+def token_request_max_seconds():
+    """Longest a token exchange or refresh can take, retries included"""
+    return STRAVA_TOKEN_RETRY_POLICY.max_duration(http_clients.HTTP_CONNECT_TIMEOUT + http_clients.HTTP_TIMEOUT)
+
+async def refresh_access_token(refresh_token):
+    """Refresh user's expired access token"""
+    if not all([STRAVA_CLIENT_ID, STRAVA_CLIENT_SECRET, refresh_token]):
+        logger.error("Missing required parameters for token refresh")
+        return None
+    try:
+        # Refreshes run under a lock, so they fail fast instead of waiting for the next window
+        response = await _request(
+            'POST',
+            STRAVA_TOKEN_URL,
+            priority=strava_ratelimit.INTERACTIVE,
+            retry_policy=STRAVA_TOKEN_RETRY_POLICY,
+            data={
+                'client_id': STRAVA_CLIENT_ID,
+                'client_secret': STRAVA_CLIENT_SECRET,
+                'refresh_token': refresh_token,
+                'grant_type': 'refresh_token'
+            }
+        )
+        return response.json() if response else None
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error(f"Error refreshing token: {str(e)}")
+        return None
+
+async def _get_activities_page(access_token, after_ts, page, per_page):
+    response = await _request(
+        'GET',
+        f"{STRAVA_API_URL}/activities",
+        params={'after': after_ts, 'page': page, 'per_page': per_page},
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    return response.json() if response else None
+
+async def get_activities(access_token, after_ts, page=1, per_page=STRAVA_PAGE_SIZE):
+    """Fetch one page of activities started after the given timestamp"""
+    try:
+        return await _get_activities_page(access_token, after_ts, page, per_page)
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error(f"Error fetching activities: {str(e)}")
+        return None
+
+async def iter_activities(access_token, after_ts, per_page=STRAVA_PAGE_SIZE):
+    """Yield activities started after the given timestamp, oldest first, page by page
+
+    Pages are only requested as the caller consumes the previous one. Strava
+    filters on `after`, so every page lies past the cursor and the walk ends
+    at the first short page. Stops early if the rate limit budget runs out and
+    raises httpx.HTTPError or CircuitOpenError if a page can't be fetched.
+    """
+    page = 1
+    while True:
+        activities = await _get_activities_page(access_token, after_ts, page, per_page)
+        if activities is None:
+            return
+        for activity in sorted(activities, key=lambda activity: activity.get('start_date') or ''):
+            yield activity
+        if len(activities) < per_page:
+            return
+        page += 1
+
+async def get_activity(access_token, activity_id):
+    """Fetch a single activity by ID
+
+    Returns None if the rate limit budget is exhausted and raises
+    httpx.HTTPError or CircuitOpenError if the activity can't be fetched.
+    """
+    response = await _request(
+        'GET',
+        f"{STRAVA_API_URL}/activities/{activity_id}",
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    return response.json() if response else None
+
+async def get_athlete(access_token):
+    """Fetch the athlete the access token belongs to"""
+    try:
+        response = await _request(
+            'GET',
+            f"{STRAVA_API_URL}/athlete",
+            headers={"Authorization": f"Bearer {access_token}"}
+        )
+        return response.json() if response else None
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error(f"Error fetching athlete: {str(e)}")
+        return None
@@ -0,0 +1,169 @@
+import os
+import time
+import logging
+import argparse
+import httpx
+from dotenv import load_dotenv
+import database
+import http_clients
+from strava_auth import STRAVA_CLIENT_ID, STRAVA_CLIENT_SECRET, STRAVA_API_URL
+import telegram
+import strava_client
+import dead_letter
+from circuit_breaker import CircuitOpenError
+from main import get_valid_access_token, notify_activity, TELEGRAM_BOT_TOKEN
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Token echoed by Strava when validating the subscription callback
+STRAVA_VERIFY_TOKEN = os.getenv('STRAVA_VERIFY_TOKEN')
+# Only events for this subscription are accepted when set
+STRAVA_SUBSCRIPTION_ID = os.getenv('STRAVA_SUBSCRIPTION_ID')
+
+def verify_subscription(mode, verify_token, challenge):
+    """Answer Strava's subscription validation request, returning the challenge or None"""
+    if mode != 'subscribe' or not challenge:
+        logger.error(f"Invalid subscription validation request (mode: {mode})")
+        return None
+    if not STRAVA_VERIFY_TOKEN or verify_token != STRAVA_VERIFY_TOKEN:
+        logger.error("Subscription validation request has an invalid verify token")
+        return None
+    logger.info("Validated Strava push subscription")
+    return challenge
+
+def is_valid_event(event):
+    """Check that a webhook payload is an event for our subscription"""
+    if not isinstance(event, dict) or 'object_type' not in event or 'owner_id' not in event:
+        return False
+    if STRAVA_SUBSCRIPTION_ID and str(event.get('subscription_id')) != STRAVA_SUBSCRIPTION_ID:
+        return False
+    return True
+
+async def handle_event(event, bot=None):
+    """Process a Strava push event
+    
+    Long-running servers pass the shared bot; without one a bot is created
+    for this event only.
+    """
+    try:
+        object_type = event.get('object_type')
+        aspect_type = event.get('aspect_type')
+        owner_id = event.get('owner_id')
+        logger.info(f"Handling Strava event: {object_type} {aspect_type} {event.get('object_id')} for athlete {owner_id}")
+
+        chat_id = await database.get_chat_id_for_athlete_async(owner_id)
+        if not chat_id:
+            return
+
+        # The athlete revoked access to our app
+        if object_type == 'athlete' and event.get('updates', {}).get('authorized') == 'false':
+            logger.info(f"Athlete {owner_id} deauthorized the app, removing user {chat_id}")
+            await database.remove_user_async(chat_id)
+            return
+
+        if object_type != 'activity' or aspect_type != 'create':
+            return
+
+        user = await database.get_user_async(chat_id)
+        if not user:
+            return
+        if bot is None:
+            bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
+        access_token = await get_valid_access_token(bot, chat_id, user)
+        if not access_token:
+            return
+
+        try:
+            activity = await strava_client.get_activity(access_token, event['object_id'])
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            # Private or deleted activities fail for good, only keep transient failures
+            if isinstance(e, CircuitOpenError) or strava_client.STRAVA_RETRY_POLICY.is_retryable(e):
+                await dead_letter.add_async(dead_letter.STRAVA_EVENT, {'event': event}, e)
+            else:
+                logger.error(f"Error fetching activity {event['object_id']}: {str(e)}")
+            return
+        if activity is None:
+            await dead_letter.add_async(dead_letter.STRAVA_EVENT, {'event': event}, 'Strava rate limit budget exhausted')
+            return
+        await notify_activity(bot, chat_id, activity)
+    except Exception as e:
+        logger.exception(f"Error handling Strava event {event}: {str(e)}")
+
+def create_subscription(callback_url):
+    """Register our callback URL with Strava (Strava validates it synchronously)"""
+    response = http_clients.get_client(http_clients.STRAVA).post(
+        f"{STRAVA_API_URL}/push_subscriptions",
+        data={
+            'client_id': STRAVA_CLIENT_ID,
+            'client_secret': STRAVA_CLIENT_SECRET,
+            'callback_url': callback_url,
+            'verify_token': STRAVA_VERIFY_TOKEN
+        }
+    )
+    response.raise_for_status()
+    return response.json()
+
+def view_subscription():
+    """List the app's push subscriptions"""
+    response = http_clients.get_client(http_clients.STRAVA).get(
+        f"{STRAVA_API_URL}/push_subscriptions",
+        params={'client_id': STRAVA_CLIENT_ID, 'client_secret': STRAVA_CLIENT_SECRET}
+    )
+    response.raise_for_status()
+    return response.json()
+
+def delete_subscription(subscription_id):
+    """Delete a push subscription"""
+    response = http_clients.get_client(http_clients.STRAVA).delete(
+        f"{STRAVA_API_URL}/push_subscriptions/{subscription_id}",
+        params={'client_id': STRAVA_CLIENT_ID, 'client_secret': STRAVA_CLIENT_SECRET}
+    )
+    response.raise_for_status()
+
+def send_fake_event(url, owner_id, activity_id, aspect_type='create'):
+    """Post an activity event to our webhook the way Strava would, for local testing"""
+    event = {
+        'aspect_type': aspect_type,
+        'event_time': int(time.time()),
+        'object_id': activity_id,
+        'object_type': 'activity',
+        'owner_id': owner_id,
+        'subscription_id': int(STRAVA_SUBSCRIPTION_ID or 0),
+        'updates': {}
+    }
+    response = httpx.post(url, json=event, timeout=30)
+    response.raise_for_status()
+    return response
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the Strava push subscription')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subscribe = subparsers.add_parser('subscribe', help='Create the push subscription')
+    subscribe.add_argument('callback_url', help='Public URL of the /strava/webhook endpoint')
+    subparsers.add_parser('view', help='Show the current push subscription')
+    unsubscribe = subparsers.add_parser('unsubscribe', help='Delete a push subscription')
+    unsubscribe.add_argument('subscription_id')
+    fake = subparsers.add_parser('fake-event', help='Post a fake activity event to a local webhook')
+    fake.add_argument('url', help='URL of the /strava/webhook endpoint')
+    fake.add_argument('owner_id', type=int, help='Strava athlete ID')
+    fake.add_argument('activity_id', type=int, help='Strava activity ID')
+    args = parser.parse_args()
+
+    if args.command == 'subscribe':
+        print(create_subscription(args.callback_url))
+    elif args.command == 'view':
+        print(view_subscription())
+    elif args.command == 'unsubscribe':
+        delete_subscription(args.subscription_id)
+        print(f"Deleted subscription {args.subscription_id}")
+    elif args.command == 'fake-event':
+        send_fake_event(args.url, args.owner_id, args.activity_id)
+        print("Event delivered")
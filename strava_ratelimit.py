@@ -0,0 +1,203 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+import database
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Request priorities
+INTERACTIVE = 'interactive'  # OAuth exchanges a user is waiting on
+BACKGROUND = 'background'    # Periodic activity checks and token refreshes
+
+# Strava's app-wide limits, updated from response headers as they are seen
+STRAVA_SHORT_LIMIT = int(os.getenv('STRAVA_SHORT_LIMIT', '200'))
+STRAVA_DAILY_LIMIT = int(os.getenv('STRAVA_DAILY_LIMIT', '2000'))
+# Share of each limit kept free for interactive requests
+STRAVA_INTERACTIVE_RESERVE = float(os.getenv('STRAVA_INTERACTIVE_RESERVE', '0.2'))
+# Longest a background request waits for the next 15-minute window
+STRAVA_RATE_LIMIT_MAX_WAIT = int(os.getenv('STRAVA_RATE_LIMIT_MAX_WAIT', '900'))
+
+SHORT_WINDOW_SECONDS = 15 * 60
+DAILY_WINDOW_SECONDS = 24 * 60 * 60
+
+# Key prefixes
+RATE_LIMIT_KEY_PREFIX = 'strava:ratelimit:'
+RATE_LIMIT_LIMITS_KEY = f"{RATE_LIMIT_KEY_PREFIX}limits"
+
+# Count a request in both windows unless either is full.
+# Returns 0 when allowed, 1 when the 15-minute window is full, 2 when the daily one is.
+ACQUIRE_SCRIPT = """
+local limits = redis.call('HMGET', KEYS[3], 'short', 'daily')
+local short_limit = math.floor((tonumber(limits[1]) or tonumber(ARGV[1])) * tonumber(ARGV[3]))
+local daily_limit = math.floor((tonumber(limits[2]) or tonumber(ARGV[2])) * tonumber(ARGV[3]))
+if tonumber(redis.call('GET', KEYS[1]) or '0') >= short_limit then
+    return 1
+end
+if tonumber(redis.call('GET', KEYS[2]) or '0') >= daily_limit then
+    return 2
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return 0
+"""
+
+# Raise the window counters to the usage Strava reports, never lowering them
+RECORD_SCRIPT = """
+for i = 1, 2 do
+    local current = tonumber(redis.call('GET', KEYS[i]) or '0')
+    if tonumber(ARGV[i]) > current then
+        redis.call('SET', KEYS[i], ARGV[i], 'EX', ARGV[i + 2])
+    end
+end
+return 1
+"""
+
+def _windows(now=None):
+    """Get the current 15-minute and daily window starts (UTC epoch seconds)"""
+    now = int(now if now is not None else time.time())
+    return now - now % SHORT_WINDOW_SECONDS, now - now % DAILY_WINDOW_SECONDS
+
+def _window_keys(now=None):
+    short_start, daily_start = _windows(now)
+    day = datetime.fromtimestamp(daily_start, tz=timezone.utc).strftime('%Y%m%d')
+    return f"{RATE_LIMIT_KEY_PREFIX}short:{short_start}", f"{RATE_LIMIT_KEY_PREFIX}daily:{day}"
+
+def _seconds_until_next_window(now=None):
+    now = now if now is not None else time.time()
+    short_start, _ = _windows(now)
+    return short_start + SHORT_WINDOW_SECONDS - now
+
+def _parse_pair(value):
+    """Parse a 'short,daily' header value"""
+    try:
+        short, daily = (int(part) for part in value.split(','))
+        return short, daily
+    except (AttributeError, ValueError):
+        return None
+
+def _acquire_args(priority):
+    share = 1.0 if priority == INTERACTIVE else 1.0 - STRAVA_INTERACTIVE_RESERVE
+    short_key, daily_key = _window_keys()
+    return (
+        ACQUIRE_SCRIPT, 3, short_key, daily_key, RATE_LIMIT_LIMITS_KEY,
+        STRAVA_SHORT_LIMIT, STRAVA_DAILY_LIMIT, share,
+        SHORT_WINDOW_SECONDS, DAILY_WINDOW_SECONDS
+    )
+
+def try_acquire(priority=BACKGROUND):
+    """Count one Strava request against the shared budget if it fits
+
+    Returns 0 when allowed, 1 when the 15-minute budget is used up and 2
+    when the daily budget is. Fails open if Redis is unavailable or not used.
+    """
+    if not database.uses_redis():
+        return 0
+    try:
+        return int(database.get_redis().eval(*_acquire_args(priority)))
+    except Exception as e:
+        logger.error(f"Error checking Strava rate limit: {str(e)}")
+        return 0
+
+async def try_acquire_async(priority=BACKGROUND):
+    """Like try_acquire, without blocking the event loop"""
+    if not database.uses_redis():
+        return 0
+    try:
+        return int(await database.get_async_redis().eval(*_acquire_args(priority)))
+    except Exception as e:
+        logger.error(f"Error checking Strava rate limit: {str(e)}")
+        return 0
+
+def _wait_or_give_up(result, priority):
+    """Turn a try_acquire result into True/False, or the seconds to wait before trying again"""
+    if result == 0:
+        return True
+    if result == 2:
+        logger.warning(f"Strava daily rate limit budget exhausted for {priority} requests")
+        return False
+    if priority == INTERACTIVE:
+        logger.warning("Strava 15-minute rate limit budget exhausted for interactive requests")
+        return False
+
+    wait_seconds = _seconds_until_next_window() + 1
+    if wait_seconds > STRAVA_RATE_LIMIT_MAX_WAIT:
+        logger.warning(f"Strava 15-minute rate limit budget exhausted, not waiting {wait_seconds:.0f}s")
+        return False
+    logger.info(f"Strava 15-minute rate limit budget exhausted, waiting {wait_seconds:.0f}s for the next window")
+    return wait_seconds
+
+def acquire(priority=BACKGROUND):
+    """Reserve budget for one Strava request, returning False if it can't be sent
+
+    Interactive requests never wait. Background requests wait for the next
+    15-minute window when the current one is used up, so a large run is paced
+    instead of running into 429s; they give up when the daily budget is gone.
+    """
+    while True:
+        outcome = _wait_or_give_up(try_acquire(priority), priority)
+        if isinstance(outcome, bool):
+            return outcome
+        time.sleep(outcome)
+
+async def acquire_async(priority=BACKGROUND):
+    """Like acquire, waiting for the next window without blocking the event loop"""
+    while True:
+        outcome = _wait_or_give_up(await try_acquire_async(priority), priority)
+        if isinstance(outcome, bool):
+            return outcome
+        await asyncio.sleep(outcome)
+
+def _usage_from_response(response):
+    """Get the (limits, usage) pairs a response reports, or None if it reports no usage"""
+    limits = _parse_pair(response.headers.get('X-RateLimit-Limit'))
+    usage = _parse_pair(response.headers.get('X-RateLimit-Usage'))
+    if response.status_code == 429:
+        logger.warning(f"Strava rate limit exceeded (usage {usage}, limits {limits})")
+        # Treat both windows as full until they roll over
+        limits = limits or (STRAVA_SHORT_LIMIT, STRAVA_DAILY_LIMIT)
+        usage = limits
+    if not usage:
+        return None
+    return limits, usage
+
+def _queue_record(pipe, limits, usage):
+    short_key, daily_key = _window_keys()
+    if limits:
+        pipe.hset(RATE_LIMIT_LIMITS_KEY, mapping={'short': limits[0], 'daily': limits[1]})
+    pipe.eval(
+        RECORD_SCRIPT, 2, short_key, daily_key,
+        usage[0], usage[1], SHORT_WINDOW_SECONDS, DAILY_WINDOW_SECONDS
+    )
+
+def record_response(response):
+    """Update the shared budget from Strava's rate limit headers"""
+    reported = _usage_from_response(response)
+    if not reported or not database.uses_redis():
+        return
+    try:
+        pipe = database.get_redis().pipeline()
+        _queue_record(pipe, *reported)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error recording Strava rate limit usage: {str(e)}")
+
+async def record_response_async(response):
+    """Like record_response, without blocking the event loop"""
+    reported = _usage_from_response(response)
+    if not reported or not database.uses_redis():
+        return
+    try:
+        pipe = database.get_async_redis().pipeline()
+        _queue_record(pipe, *reported)
+        await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error recording Strava rate limit usage: {str(e)}")
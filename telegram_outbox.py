@@ -0,0 +1,260 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import weakref
+from collections import deque
+import telegram
+import database
+from circuit_breaker import get_breaker
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and one per second per chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '8'))
+# Give up on a message after this many 429 responses
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '5'))
+# Forget per-chat send times once this many chats are tracked
+CHAT_SLOTS_MAX = 10000
+
+# Keys of the send slots shared by all processes when Redis is the storage backend
+RATE_LIMIT_KEY_PREFIX = 'telegram:ratelimit:'
+GLOBAL_SLOT_KEY = f"{RATE_LIMIT_KEY_PREFIX}global"
+CHAT_SLOT_KEY_PREFIX = f"{RATE_LIMIT_KEY_PREFIX}chat:"
+PAUSE_KEY = f"{RATE_LIMIT_KEY_PREFIX}paused"
+
+# Reserve the next send slot in KEYS[1], no earlier than the pause in KEYS[2] if given.
+# ARGV: now and the interval in milliseconds. Returns the slot in epoch milliseconds.
+RESERVE_SLOT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local slot = math.max(now, tonumber(redis.call('GET', KEYS[1]) or '0'))
+if KEYS[2] then
+    slot = math.max(slot, tonumber(redis.call('GET', KEYS[2]) or '0'))
+end
+local next_slot = slot + tonumber(ARGV[2])
+redis.call('SET', KEYS[1], next_slot, 'PX', next_slot - now + 1000)
+return slot
+"""
+
+# Pause all senders until ARGV[1] (epoch milliseconds), never shortening a longer pause
+PAUSE_SCRIPT = """
+if tonumber(ARGV[1]) > tonumber(redis.call('GET', KEYS[1]) or '0') then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+end
+return 1
+"""
+
+TELEGRAM_BREAKER = get_breaker('telegram')
+
+class TelegramOutbox:
+    """Queue of outgoing messages drained by a pool of workers within Telegram's limits
+
+    Messages to the same chat are sent at most TELEGRAM_CHAT_RATE per second and
+    in the order they were submitted: each chat has its own queue and only its
+    head message is in flight. All chats together share TELEGRAM_GLOBAL_RATE.
+    A 429 pauses the whole outbox for the `retry_after` Telegram asks for, after
+    which the message is sent again, still ahead of the rest of its chat. While Telegram keeps failing its circuit
+    opens and messages fail fast with CircuitOpenError.
+
+    With Redis storage the send slots and pauses live in Redis, so every outbox
+    of every process shares the same limits. Otherwise, or while Redis is
+    unreachable, each outbox only paces its own messages.
+    """
+
+    def __init__(self, bot, workers=OUTBOX_WORKERS):
+        self.bot = bot
+        self.workers = workers
+        # Chats whose head message may be sent, and each chat's queued messages
+        self._queue = asyncio.Queue()
+        self._chats = {}
+        self._tasks = []
+        self._global_interval = 1 / TELEGRAM_GLOBAL_RATE
+        self._chat_interval = 1 / TELEGRAM_CHAT_RATE
+        self._next_global = 0.0
+        self._next_chat = {}
+        self._paused_until = 0.0
+        self._pending = set()
+
+    def _start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        """Queue a message and wait until it is sent
+
+        Returns the sent message and raises the Telegram error if it could not
+        be delivered, like `Bot.send_message`.
+        """
+        self._start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        key = str(chat_id)
+        messages = self._chats.setdefault(key, deque())
+        messages.append((chat_id, text, parse_mode, kwargs, future))
+        # Otherwise the chat is already scheduled or in flight, and its worker
+        # schedules it again after the message ahead of this one
+        try:
+            if len(messages) == 1:
+                # Shielded, or a caller cancelled meanwhile would strand the chat's later messages
+                await asyncio.shield(self._schedule_chat(key))
+            return await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def _schedule_chat(self, key):
+        """Queue a chat for the workers once it may be sent to again"""
+        # Chats join the queue only when ready, so workers never sit idle behind a busy chat
+        delay = await self._reserve_chat_slot(key) - time.time()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, key)
+        else:
+            self._queue.put_nowait(key)
+
+    async def _reserve_shared_slot(self, key, interval, pause_key=None):
+        """Reserve the next slot of a limit shared through Redis, or None to use the local one"""
+        if not database.uses_redis():
+            return None
+        keys = [key] + ([pause_key] if pause_key else [])
+        try:
+            slot_ms = await database.get_async_redis().eval(
+                RESERVE_SLOT_SCRIPT, len(keys), *keys,
+                int(time.time() * 1000), math.ceil(interval * 1000)
+            )
+            return int(slot_ms) / 1000
+        except Exception as e:
+            logger.error(f"Error reserving shared Telegram send slot {key}: {str(e)}")
+            return None
+
+    async def _reserve_chat_slot(self, chat_id):
+        slot = await self._reserve_shared_slot(f"{CHAT_SLOT_KEY_PREFIX}{chat_id}", self._chat_interval)
+        if slot is not None:
+            return slot
+
+        now = time.time()
+        if len(self._next_chat) > CHAT_SLOTS_MAX:
+            self._next_chat = {chat: at for chat, at in self._next_chat.items() if at > now}
+        slot = max(now, self._next_chat.get(chat_id, 0.0))
+        self._next_chat[chat_id] = slot + self._chat_interval
+        return slot
+
+    async def _wait_until(self, deadline):
+        delay = deadline - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _reserve_global_slot(self):
+        slot = await self._reserve_shared_slot(GLOBAL_SLOT_KEY, self._global_interval, PAUSE_KEY)
+        if slot is None:
+            slot = max(time.time(), self._next_global, self._paused_until)
+            self._next_global = slot + self._global_interval
+        return slot
+
+    async def _wait_for_global_slot(self):
+        while True:
+            await self._wait_until(await self._reserve_global_slot())
+            # A 429 seen while waiting holds back this slot too
+            if time.time() >= self._paused_until:
+                return
+
+    async def _pause(self, seconds):
+        """Hold back all sends for `seconds`, in every process when the limits are shared"""
+        self._paused_until = max(self._paused_until, time.time() + seconds)
+        if not database.uses_redis():
+            return
+        try:
+            await database.get_async_redis().eval(
+                PAUSE_SCRIPT, 1, PAUSE_KEY,
+                math.ceil(self._paused_until * 1000), math.ceil(seconds * 1000)
+            )
+        except Exception as e:
+            logger.error(f"Error sharing Telegram rate limit pause: {str(e)}")
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            messages = self._chats[key]
+            # Drop messages whose callers stopped waiting
+            while messages and messages[0][-1].done():
+                messages.popleft()
+            if messages:
+                chat_id, text, parse_mode, kwargs, future = messages[0]
+                try:
+                    await self._deliver(chat_id, text, parse_mode, kwargs, future)
+                except asyncio.CancelledError:
+                    if not future.done():
+                        future.cancel()
+                    raise
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                messages.popleft()
+            if messages:
+                await self._schedule_chat(key)
+            else:
+                del self._chats[key]
+
+    async def _deliver(self, chat_id, text, parse_mode, kwargs, future):
+        for attempt in range(OUTBOX_MAX_RETRIES + 1):
+            await self._wait_for_global_slot()
+            TELEGRAM_BREAKER.check()
+            try:
+                message = await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, **kwargs)
+            except telegram.error.RetryAfter as e:
+                # Telegram answered, it is just throttling us
+                TELEGRAM_BREAKER.record(True)
+                if attempt == OUTBOX_MAX_RETRIES:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.warning(f"Telegram rate limit hit sending to {chat_id}, pausing for {retry_after}s")
+                await self._pause(retry_after)
+                continue
+            except telegram.error.TelegramError as e:
+                # Refused messages (blocked bot, bad request) mean Telegram itself is fine
+                TELEGRAM_BREAKER.record(isinstance(e, (telegram.error.BadRequest, telegram.error.Forbidden)))
+                raise
+            TELEGRAM_BREAKER.record(True)
+            if not future.done():
+                future.set_result(message)
+            return
+
+    async def close(self):
+        """Wait for queued messages to be sent, then stop the workers"""
+        await asyncio.gather(*self._pending, return_exceptions=True)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+# Outboxes of each event loop by bot, since their queues and workers are bound to the loop
+_outboxes = weakref.WeakKeyDictionary()
+
+def get_outbox(bot):
+    """Get the outbox of the running event loop for a bot, creating it on first use"""
+    outboxes = _outboxes.setdefault(asyncio.get_running_loop(), {})
+    # Bots can't be hashed before they are initialized; the outbox keeps its bot alive
+    outbox = outboxes.get(id(bot))
+    if outbox is None:
+        outbox = TelegramOutbox(bot)
+        outboxes[id(bot)] = outbox
+    return outbox
+
+async def send_message(bot, chat_id, text, parse_mode=None, **kwargs):
+    """Send a message through the rate limited outbox of the running event loop"""
+    return await get_outbox(bot).send_message(chat_id, text, parse_mode=parse_mode, **kwargs)
+
+async def close():
+    """Drain and stop the outboxes of the running event loop"""
+    outboxes = _outboxes.pop(asyncio.get_running_loop(), {})
+    for outbox in outboxes.values():
+        await outbox.close()
@@ -0,0 +1,155 @@
+import os
+import time
+import uuid
+import signal
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timedelta
+import database
+import strava_client
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler()  # Only use stdout/stderr
+    ]
+)
+logger = logging.getLogger(__name__)
+
+# Key prefix for the per-user refresh locks
+REFRESH_LOCK_KEY_PREFIX = 'lock:token_refresh:'
+
+# Tokens expiring within this horizon are refreshed ahead of time
+TOKEN_REFRESH_HORIZON_MINUTES = int(os.getenv('TOKEN_REFRESH_HORIZON_MINUTES', '60'))
+TOKEN_REFRESH_INTERVAL_SECONDS = int(os.getenv('TOKEN_REFRESH_INTERVAL_SECONDS', '300'))
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv('TOKEN_REFRESH_CONCURRENCY', '8'))
+# Longer than a refresh can take with all its retries, so the lock never expires
+# mid-refresh, yet short enough that a crashed holder doesn't block a user for long
+TOKEN_REFRESH_LOCK_TTL_MS = int(os.getenv(
+    'TOKEN_REFRESH_LOCK_TTL_MS',
+    str(int((strava_client.token_request_max_seconds() + 5) * 1000))
+))
+LOCK_POLL_SECONDS = 0.2
+
+# Refreshes running in this process, shared by concurrent callers
+_in_flight = {}
+
+async def _wait_for_other_refresh(chat_id, lock_key):
+    """Wait for another process to finish refreshing and return what it stored"""
+    deadline = time.monotonic() + TOKEN_REFRESH_LOCK_TTL_MS / 1000
+    while time.monotonic() < deadline:
+        if not await database.is_locked_async(lock_key):
+            break
+        await asyncio.sleep(LOCK_POLL_SECONDS)
+    # The other process stored new tokens, the cached record may still hold the old ones
+    return await database.get_user_async(chat_id, use_cache=False)
+
+async def _refresh(chat_id, valid_until):
+    # Re-read under the lock, someone may have refreshed just before we got it
+    user = await database.get_user_async(chat_id, use_cache=False)
+    if not user or user['expires_at'] > valid_until:
+        return user
+
+    new_tokens = await strava_client.refresh_access_token(user['refresh_token'])
+    if not new_tokens or 'access_token' not in new_tokens or 'expires_in' not in new_tokens:
+        logger.error(f"Failed to refresh token for user {chat_id}. Response: {new_tokens}")
+        return None
+
+    expires_at = datetime.fromtimestamp(datetime.now().timestamp() + new_tokens['expires_in'])
+    refresh_token = new_tokens.get('refresh_token', user['refresh_token']) # Use new refresh token if Strava provides it
+    if not await database.add_user_async(chat_id, new_tokens['access_token'], refresh_token, expires_at):
+        return None
+
+    logger.info(f"Refreshed token for user {chat_id}, now expires at {expires_at}")
+    return dict(user, access_token=new_tokens['access_token'], refresh_token=refresh_token, expires_at=expires_at)
+
+async def _refresh_with_lock(chat_id, valid_until):
+    lock_key = f"{REFRESH_LOCK_KEY_PREFIX}{chat_id}"
+    lock_token = uuid.uuid4().hex
+    acquired = await database.acquire_lock_async(lock_key, lock_token, TOKEN_REFRESH_LOCK_TTL_MS)
+    if acquired is None:
+        return None
+    if not acquired:
+        logger.info(f"Token for user {chat_id} is being refreshed elsewhere, waiting for it")
+        return await _wait_for_other_refresh(chat_id, lock_key)
+
+    try:
+        return await _refresh(chat_id, valid_until)
+    finally:
+        await database.release_lock_async(lock_key, lock_token)
+
+async def refresh_user_token(chat_id, valid_until=None):
+    """Make sure a user's token stays valid until `valid_until`, refreshing it if not
+
+    Only one refresh per user runs at a time: concurrent callers in this process
+    share the same refresh, and callers in other processes wait on a lock in the
+    storage backend and then read the refreshed token. Returns the user record,
+    or None if the refresh failed.
+    """
+    if valid_until is None:
+        valid_until = datetime.now() + timedelta(minutes=TOKEN_REFRESH_HORIZON_MINUTES)
+    chat_id = str(chat_id)
+
+    while True:
+        task = _in_flight.get(chat_id)
+        shared = task is not None
+        if not shared:
+            task = asyncio.create_task(_refresh_with_lock(chat_id, valid_until))
+            _in_flight[chat_id] = task
+            task.add_done_callback(lambda done: _in_flight.pop(chat_id, None))
+        # Shield the shared refresh from callers that get cancelled
+        user = await asyncio.shield(task)
+        # A refresh started by another caller may have aimed for an earlier deadline
+        if not shared or not user or user['expires_at'] > valid_until:
+            return user
+
+async def refresh_expiring_tokens(horizon_minutes=TOKEN_REFRESH_HORIZON_MINUTES, concurrency=TOKEN_REFRESH_CONCURRENCY):
+    """Refresh every token expiring within the horizon, returning how many were refreshed"""
+    valid_until = datetime.now() + timedelta(minutes=horizon_minutes)
+    chat_ids = await database.get_users_expiring_before_async(valid_until)
+    logger.info(f"Found {len(chat_ids)} tokens expiring before {valid_until}")
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def refresh(chat_id):
+        async with slots:
+            return await refresh_user_token(chat_id, valid_until)
+
+    results = await asyncio.gather(*(refresh(chat_id) for chat_id in chat_ids), return_exceptions=True)
+    refreshed = sum(1 for result in results if isinstance(result, dict))
+    logger.info(f"Refreshed {refreshed} of {len(chat_ids)} expiring tokens")
+    return refreshed
+
+async def run_refresher(once=False, horizon_minutes=TOKEN_REFRESH_HORIZON_MINUTES, interval=TOKEN_REFRESH_INTERVAL_SECONDS):
+    """Refresh expiring tokens every `interval` seconds until interrupted"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        while not stop.is_set():
+            try:
+                await refresh_expiring_tokens(horizon_minutes)
+            except Exception as e:
+                logger.exception(f"Error refreshing expiring tokens: {str(e)}")
+            if once:
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await strava_client.close()
+        await database.close_async_redis()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh Strava tokens before they expire')
+    parser.add_argument('--once', action='store_true', help='Run a single pass and exit')
+    parser.add_argument('--horizon-minutes', type=int, default=TOKEN_REFRESH_HORIZON_MINUTES, help='Refresh tokens expiring within this many minutes')
+    parser.add_argument('--interval', type=int, default=TOKEN_REFRESH_INTERVAL_SECONDS, help='Seconds between passes')
+    args = parser.parse_args()
+    asyncio.run(run_refresher(once=args.once, horizon_minutes=args.horizon_minutes, interval=args.interval))
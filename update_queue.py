@@ -0,0 +1,109 @@
+import os
+import json
+import hmac
+import logging
+import redis
+import database
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# How the webhook handles updates: 'inline' processes them before responding,
+# 'queue' appends them to the update stream for worker.py and responds immediately
+WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', 'inline')
+# Secret configured with setWebhook(secret_token=...), checked when set
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+
+# Stream settings
+UPDATE_STREAM = os.getenv('UPDATE_STREAM', 'telegram:updates')
+UPDATE_GROUP = os.getenv('UPDATE_GROUP', 'update-workers')
+UPDATE_STREAM_MAXLEN = int(os.getenv('UPDATE_STREAM_MAXLEN', '100000'))
+# Strava push events posted to api.py, drained by the same workers
+STRAVA_EVENT_STREAM = os.getenv('STRAVA_EVENT_STREAM', 'strava:events')
+
+def is_queue_mode():
+    """Check whether the webhook should enqueue updates instead of processing them"""
+    return WEBHOOK_MODE == 'queue'
+
+def check_secret_token(secret_token):
+    """Check the X-Telegram-Bot-Api-Secret-Token header against the configured secret"""
+    if not TELEGRAM_WEBHOOK_SECRET:
+        return True
+    return hmac.compare_digest(secret_token or '', TELEGRAM_WEBHOOK_SECRET)
+
+def is_valid_update(update):
+    """Check that a webhook payload looks like a Telegram update"""
+    return isinstance(update, dict) and isinstance(update.get('update_id'), int)
+
+def _encode_update(update):
+    return {'update': json.dumps(update)}
+
+def decode_update(fields):
+    """Decode the update stored in a stream entry"""
+    return json.loads(fields['update'])
+
+def _encode_strava_event(event):
+    return {'event': json.dumps(event)}
+
+def decode_strava_event(fields):
+    """Decode the Strava event stored in a stream entry"""
+    return json.loads(fields['event'])
+
+def enqueue_update(update):
+    """Append an update to the stream, returning the entry ID or None on failure"""
+    try:
+        entry_id = database.get_redis().xadd(
+            UPDATE_STREAM,
+            _encode_update(update),
+            maxlen=UPDATE_STREAM_MAXLEN,
+            approximate=True
+        )
+        logger.info(f"Enqueued update {update.get('update_id')} as stream entry {entry_id}")
+        return entry_id
+    except Exception as e:
+        logger.error(f"Error enqueueing update {update.get('update_id')}: {str(e)}")
+        return None
+
+async def enqueue_update_async(update):
+    """Append an update to the stream from an async handler"""
+    try:
+        entry_id = await database.get_async_redis().xadd(
+            UPDATE_STREAM,
+            _encode_update(update),
+            maxlen=UPDATE_STREAM_MAXLEN,
+            approximate=True
+        )
+        logger.info(f"Enqueued update {update.get('update_id')} as stream entry {entry_id}")
+        return entry_id
+    except Exception as e:
+        logger.error(f"Error enqueueing update {update.get('update_id')}: {str(e)}")
+        return None
+
+def enqueue_strava_event(event):
+    """Append a Strava push event to its stream, returning the entry ID or None on failure"""
+    try:
+        entry_id = database.get_redis().xadd(
+            STRAVA_EVENT_STREAM,
+            _encode_strava_event(event),
+            maxlen=UPDATE_STREAM_MAXLEN,
+            approximate=True
+        )
+        logger.info(f"Enqueued Strava event {event.get('object_type')} {event.get('object_id')} as stream entry {entry_id}")
+        return entry_id
+    except Exception as e:
+        logger.error(f"Error enqueueing Strava event {event.get('object_id')}: {str(e)}")
+        return None
+
+async def ensure_group(client):
+    """Create the consumer group (and the streams) if they don't exist yet"""
+    for stream in (UPDATE_STREAM, STRAVA_EVENT_STREAM):
+        try:
+            await client.xgroup_create(stream, UPDATE_GROUP, id='0', mkstream=True)
+            logger.info(f"Created consumer group {UPDATE_GROUP} on stream {stream}")
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
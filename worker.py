@@ -0,0 +1,167 @@
+import os
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+from main import get_bot
+import strava_events
+from dispatcher import ChatDispatcher
+import database
+import update_queue
+import telegram_outbox
+import strava_client
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler()  # Only use stdout/stderr
+    ]
+)
+logger = logging.getLogger(__name__)
+
+# Worker settings
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '8'))
+# Entries unacknowledged for this long are claimed from crashed or stuck consumers
+CLAIM_IDLE_MS = int(os.getenv('UPDATE_CLAIM_IDLE_MS', '60000'))
+CLAIM_INTERVAL_SECONDS = int(os.getenv('UPDATE_CLAIM_INTERVAL_SECONDS', '30'))
+# Entries delivered more often than this are acknowledged and dropped
+MAX_DELIVERIES = int(os.getenv('UPDATE_MAX_DELIVERIES', '5'))
+READ_BLOCK_MS = 5000
+READ_AHEAD_FACTOR = 4
+
+async def handle_entry(client, dispatcher, entry_id, fields, claimed=False):
+    """Process one stream entry and acknowledge it once the handlers have finished"""
+    try:
+        update = update_queue.decode_update(fields)
+        # A claimed entry was abandoned by its worker, maybe halfway through
+        await dispatcher.submit(update, resume=claimed)
+    except Exception as e:
+        # Leave the entry pending so it is claimed and retried later
+        logger.error(f"Error processing stream entry {entry_id}: {str(e)}")
+        return
+    await client.xack(update_queue.UPDATE_STREAM, update_queue.UPDATE_GROUP, entry_id)
+
+async def handle_strava_entry(client, bot, entry_id, fields):
+    """Process one Strava event entry and acknowledge it once it has been handled"""
+    try:
+        event = update_queue.decode_strava_event(fields)
+        # Transient failures end up in the dead-letter queue, not back on the stream
+        await strava_events.handle_event(event, bot=bot)
+    except Exception as e:
+        logger.error(f"Error processing Strava event entry {entry_id}: {str(e)}")
+        return
+    await client.xack(update_queue.STRAVA_EVENT_STREAM, update_queue.UPDATE_GROUP, entry_id)
+
+async def claim_stuck_entries(client, consumer, stream=update_queue.UPDATE_STREAM):
+    """Take over entries of `stream` that have been pending on another consumer for too long"""
+    claimed = []
+    start_id = '0-0'
+    while True:
+        result = await client.xautoclaim(
+            stream,
+            update_queue.UPDATE_GROUP,
+            consumer,
+            min_idle_time=CLAIM_IDLE_MS,
+            start_id=start_id,
+            count=100
+        )
+        start_id, entries = result[0], result[1]
+        for entry_id, fields in entries:
+            pending = await client.xpending_range(
+                stream,
+                update_queue.UPDATE_GROUP,
+                min=entry_id,
+                max=entry_id,
+                count=1
+            )
+            if pending and pending[0]['times_delivered'] > MAX_DELIVERIES:
+                logger.error(f"Dropping stream entry {entry_id} after {pending[0]['times_delivered']} deliveries")
+                await client.xack(stream, update_queue.UPDATE_GROUP, entry_id)
+                continue
+            claimed.append((entry_id, fields))
+        if start_id == '0-0':
+            break
+    if claimed:
+        logger.info(f"Claimed {len(claimed)} stuck entries from {stream}")
+    return claimed
+
+async def run_worker(concurrency, consumer):
+    """Drain the update and Strava event streams, running up to `concurrency` chats at once
+
+    Entries are handed to the dispatcher in stream order, so updates of one
+    chat are processed in order within this worker.
+    """
+    client = database.get_async_redis()
+    await update_queue.ensure_group(client)
+
+    bot = get_bot()
+    await bot.initialize()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    dispatcher = ChatDispatcher(bot, concurrency)
+    # Read ahead of the running updates so busy chats don't stall the others
+    slots = asyncio.Semaphore(concurrency * READ_AHEAD_FACTOR)
+    in_flight = set()
+
+    async def run_entry(stream, entry_id, fields, claimed):
+        try:
+            if stream == update_queue.STRAVA_EVENT_STREAM:
+                await handle_strava_entry(client, bot, entry_id, fields)
+            else:
+                await handle_entry(client, dispatcher, entry_id, fields, claimed)
+        finally:
+            slots.release()
+
+    async def submit(stream, entry_id, fields, claimed=False):
+        await slots.acquire()
+        task = asyncio.create_task(run_entry(stream, entry_id, fields, claimed))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    streams = (update_queue.UPDATE_STREAM, update_queue.STRAVA_EVENT_STREAM)
+    logger.info(f"Worker {consumer} consuming {', '.join(streams)} with concurrency {concurrency}")
+    last_claim = 0
+    try:
+        while not stop.is_set():
+            try:
+                if loop.time() - last_claim >= CLAIM_INTERVAL_SECONDS:
+                    last_claim = loop.time()
+                    for stream in streams:
+                        for entry_id, fields in await claim_stuck_entries(client, consumer, stream):
+                            await submit(stream, entry_id, fields, claimed=True)
+
+                response = await client.xreadgroup(
+                    update_queue.UPDATE_GROUP,
+                    consumer,
+                    {stream: '>' for stream in streams},
+                    count=concurrency,
+                    block=READ_BLOCK_MS
+                )
+                for stream, entries in response or []:
+                    for entry_id, fields in entries:
+                        await submit(stream, entry_id, fields)
+            except Exception as e:
+                logger.error(f"Error reading streams: {str(e)}")
+                await asyncio.sleep(1)
+    finally:
+        logger.info(f"Worker {consumer} stopping, waiting for {len(in_flight)} in-flight updates")
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        await telegram_outbox.close()
+        await strava_client.close()
+        await database.close_async_redis()
+        await bot.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process queued Telegram updates and Strava events from the Redis streams')
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY, help='Maximum chats processed at once')
+    parser.add_argument('--consumer', default=f"{socket.gethostname()}-{os.getpid()}", help='Consumer name within the group')
+    args = parser.parse_args()
+    asyncio.run(run_worker(args.concurrency, args.consumer))